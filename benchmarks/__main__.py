@@ -0,0 +1,187 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+import yaml
+
+from benchmarks.corpus import Corpus
+from benchmarks.server import serve
+
+PREFIX = Path(__file__).parents[1]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def get_stats(port: int):
+    with urllib.request.urlopen(f'http://127.0.0.1:{port}/stats') as response:
+        return json.loads(response.read())
+
+
+def wait_for(port: int, timeout: float = 10.) -> None:
+    deadline = time.time() + timeout
+    while True:
+        try:
+            get_stats(port)
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def peak_rss() -> float:
+    """Peak resident set size in megabytes of this process and of the largest finished child"""
+    return max(resource.getrusage(who).ru_maxrss for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]) / 1024
+
+
+def train_model(corpus: Corpus, path: Path) -> Path:
+    """Trains a tiny fastText model on texts of the corpus, it stands in for a real language model"""
+    import fasttext
+    texts = path / 'texts.txt'
+    texts.write_text('\n'.join(corpus.texts()))
+    model = fasttext.train_unsupervised(str(texts), dim=16, epoch=1, minCount=1, bucket=10000, thread=2, verbose=0)
+    model.save_model(str(path / 'model.bin'))
+    return path / 'model.bin'
+
+
+def make_todo(groups: int, users: int, memes: int, target: int = 0):
+    """Stages shaped like the default todo.yml: groups, a sample of their members and groups of verified members"""
+    students = {'type': 'user', 'ids': {'from': 'base_groups', 'count': users},
+                'include': {'user': True, 'friends': True, 'groups': True, 'posts': {'count': 20}}}
+    if target:
+        students['target'] = target
+    return {
+        'base_groups': {'type': 'group', 'ids': list(range(1, groups + 1)),
+                        'include': {'group': True, 'posts': True, 'members': {'count': -1}}},
+        'students': students,
+        'memes': {'type': 'group', 'ids': {'from': 'students', 'only_verified': True, 'count': memes, 'per_entity': True},
+                  'include': {'group': True, 'posts': {'count': 20}, 'members': {'count': 1000}}}
+    }
+
+
+def run(args, port: int, model_path: Path):
+    # fetcher reads its settings on import, so it is imported once the environment is ready
+    from fetcher.index import Manifest
+    from fetcher.process import run_fetcher, run_merger, run_ml, run_index
+    from fetcher.utils import discover, get_path
+
+    with open(PREFIX / 'fetcher' / 'methods.yml') as f:
+        methods = yaml.safe_load(f)
+    todo = make_todo(args.groups, args.users, args.memes, args.target)
+    types = {'user', 'group'}
+    report = {}
+
+    def measure(stage, func, count):
+        requests = get_stats(port).get('requests', 0)
+        start = time.time()
+        func()
+        seconds = time.time() - start
+        requests = get_stats(port).get('requests', 0) - requests
+        entities = count()
+        report[stage] = {
+            'seconds': round(seconds, 3),
+            'entities': entities,
+            'entities_per_second': round(entities / seconds, 1),
+            'requests': requests,
+            'requests_per_second': round(requests / seconds, 1),
+            'peak_rss_mb': round(peak_rss(), 1)
+        }
+
+    def merged():
+        return sum(int((Manifest(get_path(f'bundle-{t}')).read()[1] >= 0).sum()) for t in types)
+
+    measure('fetch', lambda: run_fetcher(todo, methods, batch=args.batch, engine=args.engine,
+                                         concurrency=args.concurrency, pipeline=args.pipeline,
+                                         response_cache_size=args.response_cache_size), lambda: sum(len(discover(t)) for t in types))
+    measure('merge', lambda: run_merger(types), merged)
+    measure('ml', lambda: run_ml(types, str(model_path), cache_size=0), merged)
+    measure('index', lambda: run_index(types), merged)
+    report['errors'] = {key: value for key, value in get_stats(port).items() if key.startswith('errors.')}
+    return report
+
+
+def print_report(report, baseline=None) -> None:
+    columns = ['seconds', 'entities', 'entities_per_second', 'requests', 'requests_per_second', 'peak_rss_mb']
+    print(f'{"stage":<8}' + ''.join(f'{column:>22}' for column in columns))
+    for stage, stats in report.items():
+        if stage == 'errors':
+            continue
+        print(f'{stage:<8}' + ''.join(f'{stats[column]:>22}' for column in columns))
+        if baseline and stage in baseline:
+            # relative change against the baseline, above 1 is more
+            ratios = [stats[c] / baseline[stage][c] if baseline[stage][c] else float('nan') for c in columns]
+            print(f'{"":<8}' + ''.join(f'{ratio:>21.2f}x' for ratio in ratios))
+    print(f'errors: {report["errors"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline against a local stand-in of VK API')
+    parser.add_argument('--groups', type=int, default=4, help='number of base groups')
+    parser.add_argument('--members', type=int, default=5000, help='mean number of members of a group')
+    parser.add_argument('--users', type=int, default=2000, help='number of sampled members')
+    parser.add_argument('--memes', type=int, default=3, help='number of groups sampled from every verified user')
+    parser.add_argument('--target', type=int, default=0,
+                        help='stop fetching members once this many of them pass the check, 0 fetches all of them')
+    parser.add_argument('--latency', type=float, default=0.05, help='mean latency of a request in seconds')
+    parser.add_argument('--jitter', type=float, default=0.02, help='standard deviation of latency in seconds')
+    parser.add_argument('--errors', default='6:0.005,28:0.0001,29:0.0002,30:0.01',
+                        help='probabilities of api errors per call as code:probability pairs')
+    parser.add_argument('--tokens', type=int, default=200, help='number of fake tokens')
+    parser.add_argument('--batch', action='store_true', help='pack api calls into execute requests')
+    parser.add_argument('--engine', choices=['process', 'async'], default='process')
+    parser.add_argument('--concurrency', type=int, default=1000)
+    parser.add_argument('--pipeline', action='store_true', help='run fetch stages as a pipeline')
+    parser.add_argument('--response-cache-size', type=int, default=1024, help='0 disables the cache of api responses')
+    parser.add_argument('--output', help='dump the report as json, e.g. to keep it as a baseline')
+    parser.add_argument('--baseline', help='compare the report with a report dumped before')
+    parser.add_argument('--keep', action='store_true', help='keep the data directory')
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix='vk-bench-'))
+    port = free_port()
+    os.environ.update({
+        'VK_DATA_PATH': str(workdir / 'data'),
+        'VK_API_URL': f'http://127.0.0.1:{port}/method/',
+        'VK_TOKENS': json.dumps([f'token{i}' for i in range(args.tokens)])
+    })
+    corpus = Corpus(members=args.members)
+    errors = {int(code): float(p) for code, p in (pair.split(':') for pair in args.errors.split(',') if pair)}
+    server = multiprocessing.Process(target=serve, args=(port, corpus), daemon=True,
+                                     kwargs={'latency': args.latency, 'jitter': args.jitter, 'errors': errors})
+    server.start()
+    try:
+        wait_for(port)
+        report = run(args, port, train_model(corpus, workdir))
+    finally:
+        server.terminate()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            logging.info(f'bench: data is kept in {workdir}')
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import math
+import random
+from typing import Dict, List
+
+LETTERS = 'абвгдежзиклмнопрстуфхцчшщэюя'
+
+
+def mix(*values: int) -> int:
+    """Deterministic hash of integers, every entity of the corpus is derived from its id"""
+    h = 1469598103934665603
+    for value in values:
+        h = ((h ^ value) * 1099511628211) % (1 << 64)
+    return h
+
+
+class Corpus:
+    """
+    Synthetic users and groups generated on the fly from their ids, nothing is kept in memory.
+    Lists of members, friends and subscriptions are affine permutations of the id space, so any page is O(page size).
+    """
+
+    def __init__(self, users: int = 1_000_000, groups: int = 100_000, members: int = 5000, seed: int = 239) -> None:
+        self.users = users
+        self.groups = groups
+        # mean number of members of a group
+        self.members = members
+        self.seed = seed
+        rng = random.Random(seed)
+        self.vocabulary = [''.join(rng.choice(LETTERS) for _ in range(rng.randint(3, 10))) for _ in range(5000)]
+        # texts shared by many entities, like reposts and template descriptions
+        self.reposts = [self.sentence(rng, 40) for _ in range(200)]
+
+    def sentence(self, rng: random.Random, words: int) -> str:
+        # word frequencies roughly follow Zipf's law
+        return ' '.join(self.vocabulary[min(int(rng.paretovariate(1.) - 1), len(self.vocabulary) - 1)]
+                        for _ in range(words))
+
+    def rng(self, *values: int) -> random.Random:
+        return random.Random(mix(self.seed, *values))
+
+    def permutation(self, space: int, key: int, offset: int, count: int, total: int) -> List[int]:
+        # a multiplier coprime with the size of the space makes the sequence a permutation
+        a = mix(self.seed, key, 1) % space or 1
+        while math.gcd(a, space) != 1:
+            a += 1
+        b = mix(self.seed, key, 2) % space
+        return [(a * i + b) % space + 1 for i in range(offset, min(offset + count, total))]
+
+    # users
+    def is_private(self, uid: int) -> bool:
+        return mix(self.seed, uid, 3) % 10 == 0
+
+    def user(self, uid: int) -> Dict:
+        rng = self.rng(uid, 4)
+        user = {
+            'id': uid, 'first_name': 'Иван', 'last_name': 'Иванов',
+            'sex': rng.randint(1, 2), 'verified': int(rng.random() < 0.01), 'has_photo': int(rng.random() < 0.9),
+            'city': {'id': rng.randint(1, 100), 'title': 'Москва'}, 'followers_count': int(rng.expovariate(1 / 100)),
+            'is_closed': self.is_private(uid), 'can_access_closed': not self.is_private(uid)
+        }
+        if rng.random() < 0.03:
+            user['deactivated'] = 'banned'
+        return user
+
+    def friends_count(self, uid: int) -> int:
+        return int(self.rng(uid, 5).expovariate(1 / 150))
+
+    def friends(self, uid: int, offset: int = 0, count: int = 5000) -> List[int]:
+        return self.permutation(self.users, uid, offset, count, self.friends_count(uid))
+
+    def subscriptions_count(self, uid: int) -> int:
+        return int(self.rng(uid, 6).expovariate(1 / 40))
+
+    def subscriptions(self, uid: int, offset: int = 0, count: int = 200) -> List[int]:
+        return self.permutation(self.groups, -uid, offset, count, self.subscriptions_count(uid))
+
+    # groups
+    def members_count(self, gid: int) -> int:
+        return int(self.rng(gid, 7).lognormvariate(math.log(self.members), 1.))
+
+    def members_page(self, gid: int, offset: int, count: int = 1000) -> List[int]:
+        return self.permutation(self.users, gid + self.users, offset, count, self.members_count(gid))
+
+    def group(self, gid: int) -> Dict:
+        rng = self.rng(gid, 8)
+        # a third of groups share template descriptions
+        description = rng.choice(self.reposts[:20]) if rng.random() < 0.3 else self.sentence(rng, rng.randint(20, 150))
+        return {
+            'id': gid, 'name': self.sentence(rng, 3), 'screen_name': f'club{gid}', 'is_closed': int(rng.random() < 0.1),
+            'type': 'page', 'description': description, 'status': self.sentence(rng, 5),
+            'members_count': self.members_count(gid), 'has_photo': int(rng.random() < 0.95), 'activity': 'Юмор'
+        }
+
+    # walls
+    def posts_count(self, owner_id: int) -> int:
+        return int(self.rng(owner_id, 9).expovariate(1 / 50))
+
+    def post(self, owner_id: int, i: int) -> Dict:
+        rng = self.rng(owner_id, i, 10)
+        # every fifth post is a repost of a popular text
+        text = rng.choice(self.reposts) if rng.random() < 0.2 else self.sentence(rng, rng.randint(0, 60))
+        return {
+            'id': i + 1, 'owner_id': owner_id, 'from_id': owner_id, 'date': 1600000000 - i * 3600, 'text': text,
+            'attachments': [{'type': 'photo', 'photo': {'id': i, 'owner_id': owner_id}}] if rng.random() < 0.5 else [],
+            'comments': {'count': rng.randint(0, 10)}, 'likes': {'count': rng.randint(0, 100)},
+            'reposts': {'count': rng.randint(0, 10)}, 'views': {'count': rng.randint(0, 1000)}
+        }
+
+    def wall(self, owner_id: int, offset: int = 0, count: int = 20) -> Dict:
+        total = self.posts_count(owner_id)
+        return {'count': total, 'items': [self.post(owner_id, i) for i in range(offset, min(offset + count, total))]}
+
+    def texts(self, entities: int = 1000):
+        """Yields texts of walls and groups, used to train a stand-in language model"""
+        for uid in range(1, entities + 1):
+            for post in self.wall(uid)['items']:
+                yield post['text']
+            yield self.group(uid)['description']
@@ -0,0 +1,121 @@
+import asyncio
+import json
+import random
+from collections import Counter
+from typing import Dict
+
+from aiohttp import web
+
+from benchmarks.corpus import Corpus
+
+ERROR_MESSAGES = {
+    6: 'Too many requests per second',
+    28: 'Application authorization failed',
+    29: 'Rate limit reached',
+    30: 'This profile is private'
+}
+# methods failing with error 30 for private profiles
+PRIVATE = {'friends.get', 'wall.get', 'users.getSubscriptions'}
+
+
+class ApiError(Exception):
+    def __init__(self, code: int) -> None:
+        super().__init__(code)
+        self.code = code
+
+
+class StandIn:
+    """Serves VK API methods used by the fetcher from a synthetic corpus with latency and random errors"""
+
+    def __init__(self, corpus: Corpus, latency: float = 0.05, jitter: float = 0.02, errors: Dict[int, float] = None,
+                 seed: int = 239) -> None:
+        self.corpus = corpus
+        self.latency = latency
+        self.jitter = jitter
+        # probability of every error code per call
+        self.errors = errors or {}
+        self.rng = random.Random(seed)
+        self.stats = Counter()
+        self.methods = {
+            'users.get': self.users_get,
+            'groups.getById': self.groups_get_by_id,
+            'groups.getMembers': self.groups_get_members,
+            'friends.get': self.friends_get,
+            'users.getSubscriptions': self.users_get_subscriptions,
+            'wall.get': self.wall_get,
+        }
+
+    def users_get(self, values):
+        return [self.corpus.user(int(uid)) for uid in str(values['user_ids']).split(',')]
+
+    def groups_get_by_id(self, values):
+        return [self.corpus.group(int(gid)) for gid in str(values['group_id']).split(',')]
+
+    def groups_get_members(self, values):
+        gid, offset = int(values['group_id']), int(values.get('offset', 0))
+        count = min(int(values.get('count', 1000)), 1000)
+        return {'count': self.corpus.members_count(gid), 'items': self.corpus.members_page(gid, offset, count)}
+
+    def friends_get(self, values):
+        uid = int(values['user_id'])
+        return {'count': self.corpus.friends_count(uid), 'items': self.corpus.friends(uid)}
+
+    def users_get_subscriptions(self, values):
+        uid = int(values['user_id'])
+        groups = {'count': self.corpus.subscriptions_count(uid), 'items': self.corpus.subscriptions(uid)}
+        return {'users': {'count': 0, 'items': []}, 'groups': groups}
+
+    def wall_get(self, values):
+        return self.corpus.wall(int(values['owner_id']), int(values.get('offset', 0)), int(values.get('count', 20)))
+
+    def call(self, method: str, values: Dict):
+        self.stats[f'calls.{method}'] += 1
+        for code, probability in self.errors.items():
+            if self.rng.random() < probability:
+                raise ApiError(code)
+        owner = int(values.get('user_id', values.get('owner_id', 0)))
+        if method in PRIVATE and owner > 0 and self.corpus.is_private(owner):
+            raise ApiError(30)
+        return self.methods[method](values)
+
+    def execute(self, code: str):
+        """Runs every API call of a VKScript program generated by the fetcher"""
+        decoder = json.JSONDecoder()
+        response, errors = [], []
+        for part in code.split('API.')[1:]:
+            method, args = part.split('(', 1)
+            values, _ = decoder.raw_decode(args)
+            try:
+                response.append(self.call(method, values))
+            except ApiError as e:
+                self.stats[f'errors.{e.code}'] += 1
+                response.append(False)
+                errors.append({'method': method, 'error_code': e.code, 'error_msg': ERROR_MESSAGES.get(e.code, '')})
+        return {'response': response, 'execute_errors': errors} if errors else {'response': response}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        values = dict(await request.post())
+        self.stats['requests'] += 1
+        await asyncio.sleep(max(0., self.rng.gauss(self.latency, self.jitter)))
+        try:
+            if method == 'execute':
+                return web.json_response(self.execute(values['code']))
+            return web.json_response({'response': self.call(method, values)})
+        except ApiError as e:
+            self.stats[f'errors.{e.code}'] += 1
+            error = {'error_code': e.code, 'error_msg': ERROR_MESSAGES.get(e.code, ''), 'request_params': []}
+            return web.json_response({'error': error})
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.stats))
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post('/method/{method}', self.handle)
+        app.router.add_get('/stats', self.handle_stats)
+        return app
+
+
+def serve(port: int, corpus: Corpus, **kwargs) -> None:
+    web.run_app(StandIn(corpus, **kwargs).app(), host='127.0.0.1', port=port, print=None, access_log=None)
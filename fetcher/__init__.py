@@ -1,4 +1,5 @@
 import logging
+import os
 import random
 from pathlib import Path
 
@@ -13,16 +14,22 @@ PREFIX = Path(__file__).parents[1]
 GROUPS_POSTFIX = 'groups'
 USERS_POSTFIX = 'users'
 
-# init folders to store data
-DATA_PATH = PREFIX / 'data'
+# load .env
+load_dotenv(dotenv_path=PREFIX / 'local.env')
+
+# init folders to store data, data can be kept elsewhere, e.g. by benchmarks
+DATA_PATH = Path(os.getenv('VK_DATA_PATH', PREFIX / 'data'))
 ML_PATH = DATA_PATH / 'ml'
 RAW_PATH = DATA_PATH / 'raw'
 BUNDLE_PATH = RAW_PATH / 'bundles'
+PARTIAL_PATH = RAW_PATH / 'partial'
 GROUPS_PATH = RAW_PATH / GROUPS_POSTFIX
 BUNDLED_GROUPS_PATH = BUNDLE_PATH / GROUPS_POSTFIX
 USERS_PATH = RAW_PATH / USERS_POSTFIX
 BUNDLED_USERS_PATH = BUNDLE_PATH / USERS_POSTFIX
-for path in [GROUPS_PATH, USERS_PATH, BUNDLED_GROUPS_PATH, BUNDLED_USERS_PATH, ML_PATH]:
+CACHE_PATH = DATA_PATH / 'cache'
+for path in [GROUPS_PATH, USERS_PATH, BUNDLED_GROUPS_PATH, BUNDLED_USERS_PATH, PARTIAL_PATH, ML_PATH,
+             CACHE_PATH]:
     Path(path).mkdir(parents=True, exist_ok=True)
 
 # init logging
@@ -37,5 +44,5 @@ logging.basicConfig(
 )
 multiprocessing_logging.install_mp_handler()
 
-# load .env
-load_dotenv(dotenv_path=PREFIX / 'local.env')
+# how raw entities are stored: one json file per entity or an append-only record store
+STORAGE = os.getenv('VK_STORAGE', 'json')
@@ -1,12 +1,40 @@
 import argparse
 
-from fetcher.process import init_and_run
+from fetcher.process import init_and_run, run_query
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Prepare dataset for ml')
     parser.add_argument('--skip-fetcher', action='store_true')
     parser.add_argument('--skip-merger', action='store_true')
     parser.add_argument('--skip-ml', action='store_true')
+    parser.add_argument('--skip-index', action='store_true')
     parser.add_argument('--model-path', help='path to the fasttext model')
-    args = parser.parse_args()
-    init_and_run(**vars(args))
+    parser.add_argument('--embedding-cache-size', type=int, default=1024,
+                        help='max size of the embedding cache in megabytes, 0 disables the cache')
+    parser.add_argument('--response-cache-size', type=int, default=1024,
+                        help='max size of the cache of api responses in megabytes, 0 disables the cache')
+    parser.add_argument('--batch', action='store_true', help='pack api calls into execute requests')
+    parser.add_argument('--engine', choices=['process', 'async'], default='process',
+                        help='run fetcher on a pool of processes or on a single asyncio event loop')
+    parser.add_argument('--concurrency', type=int, default=1000, help='max requests in flight for async engine')
+    parser.add_argument('--queue-size', type=int, default=10000, help='max queued entities for async engine')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='start dependent stages while their upstream stages are still being fetched')
+    parser.add_argument('--migrate-storage', action='store_true', help='move json files into the record store')
+    parser.add_argument('--clusters', type=int, default=0,
+                        help='number of inverted lists of similarity indexes, 0 builds exact indexes')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve metrics in the prometheus text format, they are always dumped to metrics.prom')
+    parser.add_argument('--profile', choices=['cprofile', 'py-spy'],
+                        help='profile every stage, cprofile covers the main process, py-spy also covers workers')
+    parser.add_argument('--query', type=int, nargs='+', help='find entities most similar to the given ones and exit')
+    parser.add_argument('--source', choices=['user', 'group'], default='user', help='type of queried entities')
+    parser.add_argument('--target', choices=['user', 'group'], default='group', help='type of entities to find')
+    parser.add_argument('-k', '--top', type=int, default=10, help='number of entities to find')
+    parser.add_argument('--nprobe', type=int, default=8, help='number of inverted lists scanned by a query')
+    args = vars(parser.parse_args())
+    query = {key: args.pop(key) for key in ['query', 'source', 'target', 'top', 'nprobe']}
+    if query['query']:
+        run_query(query.pop('query'), **query)
+    else:
+        init_and_run(**args)
@@ -0,0 +1,262 @@
+import asyncio
+import logging
+from collections import Counter
+from itertools import count
+from typing import Dict
+
+import aiohttp
+import vk_api
+from tqdm import tqdm
+
+from fetcher import metrics
+from fetcher.index import Journal
+from fetcher.methods import API_URL, API_VERSION, EXECUTE_LIMIT, count_members, plan_pages, make_code, split, \
+    prepare, extract, handle_api_error, handle_exception, get_tiers, get_group, get_cached, put_cached, \
+    unwrap, collect_pages, get_retried, defer_rest
+from fetcher.responses import ResponseCache
+from fetcher.retry import Deferred, backoff, get_code, is_transient
+from fetcher.transform import check_keys
+from fetcher.utils import save, make_chunks, Pages
+
+
+class Client:
+    """VK api client sharing one pooled http session between all coroutines"""
+
+    def __init__(self, session: aiohttp.ClientSession, concurrency: int) -> None:
+        self.session = session
+        # bound the number of requests in flight
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def method(self, token, method, values=None, raw=False):
+        values = {**(values or {}), 'v': API_VERSION, 'access_token': token}
+        async with self.semaphore:
+            with metrics.timed('vk_request_seconds', method=method):
+                async with self.session.post(API_URL + method, data=values) as response:
+                    response.raise_for_status()
+                    response = await response.json(content_type=None)
+        if 'error' in response:
+            raise vk_api.ApiError(None, method, values, raw, response['error'])
+        return response if raw else response['response']
+
+
+async def members(run, method, values, context=None, step=1000):
+    """Get group members, pages are fetched concurrently and streamed to disk"""
+    # remove 'count' from values, otherwise the request is incorrect
+    count = values.pop('count')
+    group = get_group(context) or unwrap((await run([count_members(values)]))[0])[0]
+    total = group.get('members_count')
+    if total is None:
+        # deactivated and banned groups have no members count
+        return []
+    pages = Pages(f'members-{values["group_id"]}', plan_pages(total, count, step))
+
+    failed = []
+
+    async def fetch_pages(offsets):
+        try:
+            results = await run([(method, {**values, 'offset': offset}) for offset in offsets])
+        except (aiohttp.ClientError, asyncio.TimeoutError, vk_api.VkApiError) as e:
+            results = [e] * len(offsets)
+        for offset, page in zip(offsets, results):
+            if isinstance(page, Exception):
+                failed.append(page)
+            else:
+                pages.add(offset, page['items'])
+
+    await asyncio.gather(*(fetch_pages(offsets) for offsets in make_chunks(pages.missing(), EXECUTE_LIMIT)))
+    return collect_pages(pages, failed, count)
+
+
+# methods that cannot be fully configured in yaml
+DELEGATES = {'members': members}
+
+
+# how long calls wait for other calls to be packed with into an execute request, in seconds
+BATCH_DELAY = 0.01
+
+
+class Batcher:
+    """Packs calls of concurrent coroutines, e.g. tasks of different entities, into execute requests"""
+
+    def __init__(self, send, delay: float = BATCH_DELAY) -> None:
+        # coroutine function resolving a chunk of calls, errors of calls are returned as values
+        self.send = send
+        self.delay = delay
+        self.pending = []
+        self.timer = None
+
+    async def call(self, method, values):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(((method, values), future))
+        # a full request is sent at once, otherwise calls made meanwhile join it
+        if len(self.pending) >= EXECUTE_LIMIT:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+        return await future
+
+    def flush(self) -> None:
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        pending, self.pending = self.pending, []
+        if pending:
+            asyncio.ensure_future(self.resolve(pending))
+
+    async def resolve(self, pending) -> None:
+        try:
+            results = await self.send([call for call, _ in pending])
+        except Exception as e:
+            results = [e] * len(pending)
+        for (_, future), result in zip(pending, results):
+            if not future.done():
+                future.set_result(result)
+
+
+async def acquire(token_manager, method, calls=None):
+    """Books a token for the method without blocking the event loop"""
+    token, delay = token_manager.reserve(method, calls=calls)
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return token
+
+
+def make_runner(client: Client, token_manager, batch=False, cache: ResponseCache = None):
+    """Creates a coroutine function that resolves a list of (method, values) calls concurrently"""
+
+    async def call(method, values, raw=False, calls=None):
+        for attempt in count():
+            token = await acquire(token_manager, method, calls)
+            try:
+                return token, await client.method(token, method, values, raw)
+            except (aiohttp.ClientError, asyncio.TimeoutError, vk_api.VkApiError) as e:
+                handle_exception(method, token, token_manager)
+                delay = backoff(e, method, attempt)
+                if delay is None:
+                    raise
+            await asyncio.sleep(delay)
+
+    async def cached(method, values):
+        if not cache or not cache.cacheable(method):
+            return (await call(method, values))[1]
+        key = cache.key(method, values)
+        response = cache.get(method, key)
+        if response is None:
+            async def make():
+                return (await call(method, values))[1]
+
+            response = await cache.coalesce_async(method, key, make)
+        return response
+
+    async def run(calls):
+        return await asyncio.gather(*(cached(method, values) for method, values in calls))
+
+    async def call_chunk(chunk):
+        # packed calls count against daily quotas of their own methods
+        token, response = await call('execute', {'code': make_code(chunk)}, raw=True,
+                                     calls=Counter(method for method, _ in chunk))
+        return split(chunk, response, on_error=lambda code, method: handle_api_error(
+            code, method, token, token_manager))
+
+    # calls of all coroutines sharing the runner are packed together
+    batcher = Batcher(call_chunk)
+
+    async def run_batch(calls):
+        results, misses = get_cached(cache, calls)
+        for attempt in count():
+            made = await asyncio.gather(*(batcher.call(*calls[i]) for i in misses))
+            for i, result in zip(misses, made):
+                results[i] = result
+            put_cached(cache, calls, results, misses)
+            # only failed calls are packed into the next execute request
+            delays = {i: backoff(results[i], calls[i][0], attempt) for i in misses
+                      if isinstance(results[i], vk_api.VkApiError)}
+            misses = [i for i, delay in delays.items() if delay is not None]
+            if not misses:
+                return results
+            await asyncio.sleep(max(delays[i] for i in misses))
+
+    return run_batch if batch else run
+
+
+async def resolve(run, uid, entity_type, key, task, context=None):
+    request = prepare(uid, entity_type, task)
+    # check whether the method can be executed directly
+    delegate = DELEGATES.get(key)
+    if delegate:
+        return await delegate(run, task['method'], request, context)
+    return extract(unwrap((await run([(task['method'], request)]))[0]), task)
+
+
+async def fetch(uid, entity_type, tasks: Dict[str, Dict], run, journal: Journal = None, precheck=False,
+                retry: Deferred = None) -> Dict[int, Deferred]:
+    """Fetches an entity with a runner shared by all entities of the queue"""
+    if journal:
+        journal.start(uid)
+    # dictionary with resolved data
+    data, tasks = get_retried(tasks, retry)
+    # error classes of failed tasks
+    errors = {}
+
+    async def fetch_task(key, task):
+        try:
+            data[key] = await resolve(run, uid, entity_type, key, task, data)
+        except (aiohttp.ClientError, asyncio.TimeoutError, vk_api.VkApiError) as e:
+            # errors are already handled by the runner, transient ones are retried at the end of the stage
+            if is_transient(e):
+                errors[key] = get_code(e)
+
+    # tasks of the same cost are independent, so they run concurrently,
+    # costlier tasks like members reuse data of cheaper ones
+    tiers = get_tiers(tasks)
+    for n, tier in enumerate(tiers):
+        await asyncio.gather(*(fetch_task(key, task) for key, task in tier.items()))
+        if errors:
+            defer_rest(errors, tiers, n)
+            return {uid: Deferred(data, errors)}
+        if precheck and not check_keys(data, entity_type, tier):
+            break
+    save(uid, entity_type, data)
+    if journal:
+        journal.done(uid)
+    return {}
+
+
+async def run_queue(ids, entity_type, tasks: Dict[str, Dict], token_manager, concurrency=1000, queue_size=10000,
+                    batch=False, journal: Journal = None, precheck=False, cache: ResponseCache = None,
+                    retries: Dict[int, Deferred] = None) -> Dict[int, Deferred]:
+    """Fetches entities, `retries` are deferred entities fetched again, returns entities deferred this time"""
+    retries = retries or {}
+    deferred = {}
+    # bounded queue keeps memory flat regardless of the number of ids
+    queue = asyncio.Queue(maxsize=queue_size)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        run = make_runner(Client(session, concurrency), token_manager, batch, cache)
+        with tqdm(total=len(ids)) as progress:
+            async def worker():
+                while True:
+                    uid = await queue.get()
+                    metrics.set_gauge('fetch_queue_depth', queue.qsize())
+                    try:
+                        deferred.update(await fetch(uid, entity_type, tasks, run, journal, precheck, retries.get(uid)))
+                    except Exception:
+                        logging.exception(f'fetch: failed to fetch {entity_type} {uid}')
+                    finally:
+                        progress.update()
+                        queue.task_done()
+
+            workers = [asyncio.create_task(worker()) for _ in range(min(concurrency, len(ids)))]
+            for uid in ids:
+                await queue.put(uid)
+                metrics.set_gauge('fetch_queue_depth', queue.qsize())
+            await queue.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    return deferred
+
+
+def fetch_all(ids, entity_type, tasks: Dict[str, Dict], token_manager, **kwargs) -> Dict[int, Deferred]:
+    """Fetches all entities from a single process using asyncio"""
+    return asyncio.run(run_queue(ids, entity_type, tasks, token_manager, **kwargs))
@@ -0,0 +1,143 @@
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from fetcher import CACHE_PATH, metrics
+from fetcher.utils import make_chunks, flatten
+
+# model used by worker processes, it is inherited through fork instead of being pickled
+model = None
+
+
+def compute(texts: List[str]) -> np.ndarray:
+    return np.stack([model.get_sentence_vector(text) for text in texts]).astype(np.float32)
+
+
+def get_fingerprint(model_path: Path, sample: int = 1 << 20) -> str:
+    """Identifies a model by its size and its first and last megabytes, hashing a whole model takes too long"""
+    size = model_path.stat().st_size
+    digest = hashlib.md5(str(size).encode())
+    with model_path.open('rb') as f:
+        digest.update(f.read(sample))
+        f.seek(max(0, size - sample))
+        digest.update(f.read(sample))
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent mapping of (model fingerprint, text) to a vector, texts are addressed by hash.
+    Least recently used vectors are evicted once the cache grows over `max_size` bytes.
+    """
+
+    def __init__(self, fingerprint: str, dim: int, max_size: int,
+                 file: Path = CACHE_PATH / 'embeddings.sqlite') -> None:
+        self.fingerprint = fingerprint.encode()
+        # every row holds a 16 bytes key, a vector and a timestamp
+        self.max_rows = max_size // (16 + 4 * dim + 8)
+        self.db = sqlite3.connect(str(file))
+        self.db.execute('CREATE TABLE IF NOT EXISTS vectors (key BLOB PRIMARY KEY, vector BLOB, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS vectors_used ON vectors (used)')
+
+    def key(self, text: str) -> bytes:
+        return hashlib.md5(self.fingerprint + text.encode()).digest()
+
+    def get(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        now = time.time()
+        # sqlite limits the number of query parameters
+        for chunk in make_chunks(keys, 500):
+            marks = ','.join('?' * len(chunk))
+            found.update(self.db.execute(f'SELECT key, vector FROM vectors WHERE key IN ({marks})', chunk))
+            self.db.execute(f'UPDATE vectors SET used = ? WHERE key IN ({marks})', [now, *chunk])
+        self.db.commit()
+        return {key: np.frombuffer(vector, np.float32) for key, vector in found.items()}
+
+    def put(self, keys: List[bytes], vectors: np.ndarray) -> None:
+        now = time.time()
+        self.db.executemany('INSERT OR REPLACE INTO vectors VALUES (?, ?, ?)',
+                            ((key, vector.tobytes(), now) for key, vector in zip(keys, vectors)))
+        excess = self.db.execute('SELECT COUNT(*) FROM vectors').fetchone()[0] - self.max_rows
+        if excess > 0:
+            self.db.execute('DELETE FROM vectors WHERE key IN (SELECT key FROM vectors ORDER BY used LIMIT ?)',
+                            (excess,))
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.close()
+
+
+class Embedder:
+    """Computes sentence vectors of texts in batches on a pool of processes sharing the model"""
+
+    def __init__(self, fasttext_model, workers: int = None, batch_size: int = 1024,
+                 cache: EmbeddingCache = None) -> None:
+        self.model = fasttext_model
+        self.dim = fasttext_model.get_dimension()
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.cache = cache
+        self.pool = None
+
+    def __enter__(self):
+        global model
+        model = self.model
+        # forked workers share memory pages of the loaded model with the parent
+        self.pool = multiprocessing.get_context('fork').Pool(self.workers)
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.pool.terminate()
+        self.pool = None
+        if self.cache:
+            self.cache.close()
+
+    def compute(self, texts: List[str]) -> np.ndarray:
+        matrix = np.empty((len(texts), self.dim), dtype=np.float32)
+        batches = list(make_chunks(texts, self.batch_size))
+        start = time.perf_counter()
+        for i, vectors in enumerate(self.pool.imap(compute, batches)):
+            matrix[i * self.batch_size:i * self.batch_size + len(vectors)] = vectors
+        metrics.inc('texts_embedded_total', len(texts))
+        metrics.inc('embedding_seconds_total', time.perf_counter() - start)
+        return matrix
+
+    def vectors(self, texts: List[str]) -> np.ndarray:
+        """Returns vectors of unique texts as rows of a float32 matrix, cached vectors are not computed again"""
+        if not self.cache:
+            return self.compute(texts)
+        keys = [self.cache.key(text) for text in texts]
+        cached = self.cache.get(keys)
+        matrix = np.empty((len(texts), self.dim), dtype=np.float32)
+        misses = []
+        for i, key in enumerate(keys):
+            if key in cached:
+                matrix[i] = cached[key]
+            else:
+                misses.append(i)
+        metrics.inc('embedding_cache_hits_total', len(texts) - len(misses))
+        if misses:
+            matrix[misses] = self.compute([texts[i] for i in misses])
+            self.cache.put([keys[i] for i in misses], matrix[misses])
+        return matrix
+
+    def embed(self, parts: List[List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Averages vectors of text parts of every entity, identical texts are computed once.
+        Returns a mask of entities having at least one part and their embeddings.
+        """
+        lengths = np.array([len(p) for p in parts])
+        mask = lengths > 0
+        # map every part to the index of its unique text
+        unique = {}
+        inverse = np.fromiter((unique.setdefault(text, len(unique)) for text in flatten(parts)), np.int64)
+        vectors = self.vectors(list(unique))
+        offsets = np.concatenate([[0], np.cumsum(lengths[mask])[:-1]]).astype(np.int64)
+        sums = np.add.reduceat(vectors[inverse], offsets, axis=0) if len(inverse) else vectors
+        return mask, sums / lengths[mask, None].astype(np.float32)
@@ -8,7 +8,3 @@ class NoTokenError(FetcherError):
 
 class FileDamagedError(FetcherError):
     pass
-
-
-class DamagedEntitiesFoundError(FetcherError):
-    pass
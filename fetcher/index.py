@@ -0,0 +1,146 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Tuple
+
+import numpy as np
+
+# every entry of a log is a pair of little-endian int64: id and value
+DTYPE = np.dtype('<i8')
+
+
+def latest(entries: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns sorted ids of log entries and the last value of each id"""
+    entries = entries[::-1]
+    ids, first = np.unique(entries[:, 0], return_index=True)
+    return ids, entries[first, 1]
+
+
+def lookup(ids: np.ndarray, keys: np.ndarray, values: np.ndarray, default: int) -> np.ndarray:
+    """Returns values of the given ids, `keys` must be sorted, ids without a value get the default"""
+    if not len(keys):
+        return np.full(len(ids), default, DTYPE)
+    positions = np.minimum(np.searchsorted(keys, ids), len(keys) - 1)
+    return np.where(keys[positions] == ids, values[positions], default)
+
+
+class IdLog:
+    """Append-only log of (id, value) pairs, the last value appended for an id wins"""
+
+    def __init__(self, file: Path) -> None:
+        self.file = file
+
+    @contextmanager
+    def locked(self):
+        """Opens the log for appending under an exclusive lock"""
+        while True:
+            f = self.file.open('ab')
+            fcntl.flock(f, fcntl.LOCK_EX)
+            # the log might have been replaced by compaction while waiting for the lock
+            if self.file.exists() and os.fstat(f.fileno()).st_ino == self.file.stat().st_ino:
+                break
+            f.close()
+        try:
+            yield f
+        finally:
+            f.close()
+
+    def append(self, uids: Iterable[int], values: Iterable[int]) -> None:
+        entries = np.column_stack([np.fromiter(uids, DTYPE), np.fromiter(values, DTYPE)])
+        with self.locked() as f:
+            f.write(entries.tobytes())
+
+    def raw(self) -> np.ndarray:
+        if not self.file.exists():
+            return np.empty((0, 2), DTYPE)
+        data = np.fromfile(self.file, DTYPE)
+        # a partially written entry is ignored
+        return data[:len(data) - len(data) % 2].reshape(-1, 2)
+
+    def read(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns sorted ids and their latest values"""
+        return latest(self.raw())
+
+    def compact(self, drop: int = None) -> None:
+        """Rewrites the log keeping only the latest value of every id, ids with the `drop` value are discarded"""
+        with self.locked():
+            ids, values = self.read()
+            if drop is not None:
+                ids, values = ids[values != drop], values[values != drop]
+            tmp = self.file.with_suffix('.tmp')
+            np.column_stack([ids, values]).astype(DTYPE).tofile(tmp)
+            os.replace(tmp, self.file)
+
+    def exists(self) -> bool:
+        return self.file.exists()
+
+
+class IdIndex(IdLog):
+    """Persistent set of ids of stored entities"""
+
+    def add(self, *uids: int) -> None:
+        self.append(uids, [1] * len(uids))
+
+    def remove(self, *uids: int) -> None:
+        self.append(uids, [0] * len(uids))
+
+    def ids(self) -> np.ndarray:
+        entries = self.raw()
+        ids, values = latest(entries)
+        ids = ids[values == 1]
+        # compact once removed and overwritten entries dominate the log
+        if len(entries) > 2 * len(ids) + 1024:
+            self.compact(drop=0)
+        return ids
+
+    def missing(self, ids: Iterable[int]) -> np.ndarray:
+        return np.setdiff1d(np.fromiter(ids, DTYPE), self.ids(), assume_unique=True)
+
+
+class Journal(IdLog):
+    """Write-ahead log of fetched entities, an entity is in flight from the start of its fetch until it is saved"""
+
+    def start(self, *uids: int) -> None:
+        self.append(uids, [1] * len(uids))
+
+    def done(self, *uids: int) -> None:
+        self.append(uids, [0] * len(uids))
+
+    def pending(self) -> np.ndarray:
+        ids, values = self.read()
+        return ids[values == 1]
+
+
+class Manifest:
+    """Records the bundle every entity has been merged into and the stamp the entity had at that moment"""
+
+    def __init__(self, path: Path) -> None:
+        self.bundles = IdLog(path / 'manifest-bundles.idx')
+        self.stamps = IdLog(path / 'manifest-stamps.idx')
+        # number of the next bundle, kept under id 0
+        self.counter = IdLog(path / 'manifest-counter.idx')
+
+    def add(self, uids: np.ndarray, bundle: int, stamps: np.ndarray) -> None:
+        # an interrupted write leaves an old stamp, so the entity is merged once again
+        self.bundles.append(uids, np.full(len(uids), bundle))
+        self.stamps.append(uids, stamps)
+
+    def reserve(self, count: int) -> int:
+        """Returns the first of `count` new bundle numbers, numbers are never reused even after bundles are removed"""
+        with self.counter.locked() as f:
+            _, values = self.counter.read()
+            if len(values):
+                start = int(values[0])
+            else:
+                # manifests written before the counter still list every bundle they have ever assigned
+                start = int(self.bundles.raw()[:, 1].max(initial=-1)) + 1
+            f.write(np.array([[0, start + count]], DTYPE).tobytes())
+        return start
+
+    def drop(self, uids: np.ndarray) -> None:
+        self.bundles.append(uids, np.full(len(uids), -1))
+
+    def read(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns sorted ids of merged entities and their bundles, dropped entities have bundle -1"""
+        return self.bundles.read()
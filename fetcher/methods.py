@@ -1,76 +1,391 @@
+import json
 import logging
+import os
+import random
 import sys
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 from math import ceil
 from string import Template
-from typing import Dict
+from typing import Dict, List, Tuple
 
 import vk_api
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
-from fetcher.utils import deep_merge, save, flatten, sample
+from fetcher import metrics
+from fetcher.index import Journal
+from fetcher.responses import ResponseCache
+from fetcher.retry import Deferred, backoff, get_code, is_transient
+from fetcher.transform import check_keys, project
+from fetcher.utils import deep_merge, save, make_chunks, Pages
 
+# the api can be served elsewhere, e.g. by the stand-in server of benchmarks
+API_URL = os.getenv('VK_API_URL', 'https://api.vk.com/method/')
+API_VERSION = '5.122'
+# maximum number of api calls VK allows within a single execute request
+EXECUTE_LIMIT = 25
 
-def members(query, method, values, step=1000):
-    """Get all group members"""
+
+def count_members(values):
+    return 'groups.getById', {'group_id': values['group_id'], 'fields': 'members_count'}
+
+
+def plan_pages(total, count, step=1000) -> List[int]:
+    """Returns offsets of pages to fetch, a sample is drawn from randomly chosen pages"""
+    offsets = list(range(0, total, step))
+    if count == -1 or count >= total:
+        return offsets
+    return sorted(random.sample(offsets, ceil(count / step)))
+
+
+def get_group(context):
+    """Returns the group fetched by another task of the entity"""
+    return (context or {}).get('group')
+
+
+def members(run, method, values, context=None, step=1000, workers=8):
+    """Get group members, pages are fetched concurrently and streamed to disk"""
     # remove 'count' from values, otherwise the request is incorrect
     count = values.pop('count')
-    if count == -1:
-        count = query(method='groups.getById', values={
-            'group_id': values['group_id'],
-            'fields': 'members_count'
-        })[0]['members_count']
-    total = ceil(count / step)
-    return sample(flatten([
-        query(method=method, values={**values, 'offset': offset * step})['items'] for offset in range(total)
-    ]), count)
-
-
-def fetch(uid, entity_type, tasks: Dict[str, Dict], token_manager):
-    # methods that cannot be fully configured in yaml
-    delegates = {'members': members}
-    # dictionary with resolved data
-    data = dict()
+    group = get_group(context) or unwrap(run([count_members(values)])[0])[0]
+    total = group.get('members_count')
+    if total is None:
+        # deactivated and banned groups have no members count
+        return []
+    pages = Pages(f'members-{values["group_id"]}', plan_pages(total, count, step))
 
-    for key, task in tasks.items():
-        method = task['method']
-        token = token_manager.get(method)
+    failed = []
+
+    def fetch_pages(offsets):
         try:
-            session = vk_api.VkApi(token=token, api_version='5.122')
-            # fill all required fields of the request like uid and merge them with method defaults
-            patch = {k: Template(v).substitute(uid=uid) for k, v in task['bind'][entity_type].items()}
-            request = deep_merge(task['request'], patch)
-            # check whether the method can be executed directly
-            delegate = delegates.get(key)
-            if delegate:
-                response = delegate(session.method, method, request)
-            else:
-                response = session.method(method, values=request)
-                # extract payload from complicated json structure
-                for step in task['extract']:
-                    response = response[step]
-            data[key] = response
-
-        except (RequestException, vk_api.VkApiError):
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            if exc_type is vk_api.ApiError:
-                code = exc_value.code
-                msg = f'Got VkApi #{code} on {method}'
-                # access denied [15] / profile is banned [18] / profile is private [30]
-                if code in [15, 18, 30]:
-                    pass
-                # token has expired
-                elif code == 28:
-                    logging.warning(f'{msg} - token "{token}" has expired, disabling it')
-                    token_manager.report(token)
-                # token is exhausted, disable it
-                elif code == 29:
-                    logging.warning(f'{msg} - disabling corresponding token')
-                    token_manager.report(token, method)
-                # print unknown code
-                else:
-                    logging.warning(msg)
+            results = run([(method, {**values, 'offset': offset}) for offset in offsets])
+        except (RequestException, vk_api.VkApiError) as e:
+            results = [e] * len(offsets)
+        for offset, page in zip(offsets, results):
+            if isinstance(page, Exception):
+                failed.append(page)
             else:
-                # TODO: handle other exceptions
-                logging.warning(f'Unknown exception occurred: {exc_value}')
+                pages.add(offset, page['items'])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # consume results to propagate errors
+        list(executor.map(fetch_pages, make_chunks(pages.missing(), EXECUTE_LIMIT)))
+    return collect_pages(pages, failed, count)
+
+
+def collect_pages(pages: Pages, failed: List[Exception], count):
+    """Samples fetched pages, a partial list is never returned, the first failure is raised instead"""
+    if not pages.missing():
+        return pages.collect(count)
+    permanent = [e for e in failed if not is_transient(e)]
+    if permanent:
+        # pages failing for good are never fetched, so fetched pages are not resumed either
+        pages.drop()
+        raise permanent[0]
+    # fetched pages are kept, so a retry of the task requests only missing pages
+    raise failed[0]
+
+
+# methods that cannot be fully configured in yaml
+DELEGATES = {'members': members}
+
+
+def make_code(calls: List[Tuple[str, Dict]]) -> str:
+    """Packs api calls into a VKScript program returning all responses as an array"""
+    return 'return [{}];'.format(
+        ','.join(f'API.{method}({json.dumps(values, ensure_ascii=False)})' for method, values in calls))
+
+
+def split(calls: List[Tuple[str, Dict]], response: Dict, on_error=None) -> List:
+    """Splits raw execute response into per-call results, failed calls resolve to their errors"""
+    # execute_errors are listed in the same order as the failed calls
+    errors = iter(response.get('execute_errors', []))
+    results = []
+    for (method, values), result in zip(calls, response['response']):
+        if result is False:
+            error = next(errors, {})
+            if on_error:
+                on_error(error.get('error_code'), error.get('method', method))
+            result = vk_api.ApiError(None, method, values, False, {'error_msg': 'unknown error', **error,
+                                                                    'error_code': error.get('error_code')})
+        results.append(result)
+    return results
+
+
+def unwrap(result):
+    """Raises the error of a failed call of an execute request"""
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+class Redirect(HTTPAdapter):
+    """Sends requests of vk_api, which has the api url hardcoded, to API_URL"""
+
+    def send(self, request, **kwargs):
+        request.url = API_URL + request.url.split('/method/', 1)[1]
+        return super().send(request, **kwargs)
+
+
+def get_session(token) -> vk_api.VkApi:
+    session = vk_api.VkApi(token=token, api_version=API_VERSION)
+    # vk_api retries [6] with the same token forever, the error goes to backoff and the token scheduler instead
+    session.error_handlers.pop(vk_api.vk_api.TOO_MANY_RPS_CODE, None)
+    if not API_URL.startswith('https://api.vk.com/'):
+        session.http.mount('https://api.vk.com/method/', Redirect())
+        session.http.mount('https://api.vk.ru/method/', Redirect())
+    return session
+
+
+def get_cached(cache: ResponseCache, calls: List[Tuple[str, Dict]]) -> Tuple[List, List[int]]:
+    """Returns cached responses of calls, None for the rest, and positions of calls to make"""
+    results = [None] * len(calls)
+    if cache:
+        for i, (method, values) in enumerate(calls):
+            if cache.cacheable(method):
+                results[i] = cache.get(method, cache.key(method, values))
+    return results, [i for i, result in enumerate(results) if result is None]
+
+
+def put_cached(cache: ResponseCache, calls: List[Tuple[str, Dict]], results: List, made: List[int]) -> None:
+    if cache:
+        for i in made:
+            method, values = calls[i]
+            if not isinstance(results[i], Exception) and cache.cacheable(method):
+                cache.put(method, cache.key(method, values), results[i])
+
+
+def make_runner(token_manager, batch=False, cache: ResponseCache = None):
+    """
+    Creates a function that resolves a list of (method, values) calls, every call is made with its own token.
+    Calls found in the cache are resolved without a token.
+    """
+
+    def call(method, values, raw=False, calls=None):
+        for attempt in count():
+            token = token_manager.get(method, calls=calls)
+            try:
+                session = get_session(token)
+                with metrics.timed('vk_request_seconds', method=method):
+                    return token, session.method(method, values=values, raw=raw)
+            except (RequestException, vk_api.VkApiError) as e:
+                handle_exception(method, token, token_manager)
+                delay = backoff(e, method, attempt)
+                if delay is None:
+                    raise
+            time.sleep(delay)
+
+    def cached(method, values):
+        if not cache or not cache.cacheable(method):
+            return call(method, values)[1]
+        key = cache.key(method, values)
+        response = cache.get(method, key)
+        if response is None:
+            response = cache.coalesce(method, key, lambda: call(method, values)[1])
+        return response
+
+    def run(calls):
+        return [cached(method, values) for method, values in calls]
+
+    def run_batch(calls):
+        results, misses = get_cached(cache, calls)
+        for attempt in count():
+            for chunk in make_chunks(misses, EXECUTE_LIMIT):
+                packed = [calls[i] for i in chunk]
+                # packed calls count against daily quotas of their own methods
+                token, response = call('execute', {'code': make_code(packed)}, raw=True,
+                                       calls=Counter(method for method, _ in packed))
+                for i, result in zip(chunk, split(packed, response, on_error=lambda code, method:
+                                                  handle_api_error(code, method, token, token_manager))):
+                    results[i] = result
+            put_cached(cache, calls, results, misses)
+            # only failed calls are packed into the next execute request
+            delays = {i: backoff(results[i], calls[i][0], attempt) for i in misses
+                      if isinstance(results[i], vk_api.VkApiError)}
+            misses = [i for i, delay in delays.items() if delay is not None]
+            if not misses:
+                return results
+            time.sleep(max(delays[i] for i in misses))
+
+    return run_batch if batch else run
+
+
+def prepare(uid, entity_type, task):
+    """Fills all required fields of the request like uid and merges them with method defaults"""
+    patch = {k: Template(v).substitute(uid=uid) for k, v in task['bind'][entity_type].items()}
+    return deep_merge(task['request'], patch)
+
+
+def extract(response, task):
+    """Extracts payload from complicated json structure, fields out of the schema of the task are stripped"""
+    for step in task['extract']:
+        response = response[step]
+    return project(response, task['schema']) if 'schema' in task else response
+
+
+def project_task(task: Dict, schema: List[str] = None) -> Dict:
+    """
+    Requests only fields of the schema which are not returned by default and keeps them in the payload.
+    Fields requested explicitly are kept as well.
+    """
+    if schema is None:
+        return task
+    request = dict(task['request'])
+    if request.get('fields'):
+        schema = schema + [field for field in request['fields'].split(',') if field not in schema]
+    elif 'defaults' in task:
+        request['fields'] = ','.join(field for field in schema if field not in task['defaults'])
+    return {**task, 'request': request, 'schema': schema}
+
+
+def resolve(run, uid, entity_type, key, task, context=None):
+    """Resolves a task of an entity, delegates may reuse data of other tasks of the entity passed as context"""
+    request = prepare(uid, entity_type, task)
+    # check whether the method can be executed directly
+    delegate = DELEGATES.get(key)
+    if delegate:
+        return delegate(run, task['method'], request, context)
+    return extract(unwrap(run([(task['method'], request)])[0]), task)
+
+
+def handle_api_error(code, method, token, token_manager):
+    msg = f'Got VkApi #{code} on {method}'
+    metrics.inc('vk_api_errors_total', code=code, method=method)
+    # access denied [15] / profile is banned [18] / profile is private [30]
+    if code in [15, 18, 30]:
+        pass
+    # token has expired
+    elif code == 28:
+        logging.warning(f'{msg} - token "{token}" has expired, disabling it')
+        token_manager.report(token)
+    # token is exhausted, disable it
+    elif code == 29:
+        logging.warning(f'{msg} - disabling corresponding token')
+        token_manager.report(token, method)
+    # print unknown code
+    else:
+        logging.warning(msg)
+
+
+def handle_exception(method, token, token_manager):
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    if exc_type is vk_api.ApiError:
+        handle_api_error(exc_value.code, method, token, token_manager)
+    else:
+        # TODO: handle other exceptions
+        metrics.inc('vk_api_errors_total', code='network', method=method)
+        logging.warning(f'Unknown exception occurred: {exc_value}')
+
+
+def get_tiers(tasks: Dict[str, Dict]) -> List[Dict[str, Dict]]:
+    """Groups tasks by cost, cheaper tasks go first"""
+    tiers = defaultdict(dict)
+    for key, task in tasks.items():
+        tiers[task.get('cost', 1)][key] = task
+    return [tiers[cost] for cost in sorted(tiers)]
+
+
+def get_retried(tasks: Dict[str, Dict], retry: Deferred = None) -> Tuple[Dict, Dict[str, Dict]]:
+    """Returns data an entity starts with and tasks to resolve, a retry resolves only failed tasks"""
+    if retry is None:
+        return dict(), tasks
+    return dict(retry.data), {key: task for key, task in tasks.items() if key in retry.errors}
+
+
+def defer_rest(errors: Dict[str, object], tiers: List[Dict[str, Dict]], tier: int) -> None:
+    # the check and costlier tasks may need failed keys, so later tiers are deferred with them
+    for rest in tiers[tier + 1:]:
+        errors.update(dict.fromkeys(rest))
+
+
+def fetch(uid, entity_type, tasks: Dict[str, Dict], token_manager, batch=False, journal: Journal = None,
+          precheck=False, cache: ResponseCache = None, retry: Deferred = None) -> Dict[int, Deferred]:
+    """
+    Fetches an entity, with precheck an entity failing the rules of fetched keys is saved without the rest.
+    An entity with tasks failed by transient errors is not saved but returned as deferred.
+    """
+    if journal:
+        journal.start(uid)
+    run = make_runner(token_manager, batch, cache)
+    # dictionary with resolved data
+    data, tasks = get_retried(tasks, retry)
+    # error classes of failed tasks
+    errors = {}
+
+    tiers = get_tiers(tasks) if precheck else [tasks]
+    for n, tier in enumerate(tiers):
+        for key, task in tier.items():
+            try:
+                data[key] = resolve(run, uid, entity_type, key, task, data)
+            except (RequestException, vk_api.VkApiError) as e:
+                # errors are already handled by the runner, transient ones are retried at the end of the stage
+                if is_transient(e):
+                    errors[key] = get_code(e)
+        if errors:
+            defer_rest(errors, tiers, n)
+            return {uid: Deferred(data, errors)}
+        if precheck and not check_keys(data, entity_type, tier):
+            break
 
     save(uid, entity_type, data)
+    if journal:
+        journal.done(uid)
+    return {}
+
+
+def get_chunk_size(tasks: Dict[str, Dict]) -> int:
+    """Returns the number of entities whose plain tasks fill an execute request"""
+    plain = sum(1 for key in tasks if key not in DELEGATES)
+    return max(1, EXECUTE_LIMIT // max(1, plain))
+
+
+def fetch_many(uids, entity_type, tasks: Dict[str, Dict], token_manager, journal: Journal = None, precheck=False,
+               cache: ResponseCache = None) -> Dict[int, Deferred]:
+    """Fetches several entities at once, packing their api calls into execute requests"""
+    if journal:
+        journal.start(*uids)
+    run = make_runner(token_manager, batch=True, cache=cache)
+    data = {uid: dict() for uid in uids}
+    errors = {uid: dict() for uid in uids}
+    alive = list(uids)
+
+    # without precheck all tasks form a single tier, so execute requests are filled up
+    tiers = get_tiers(tasks) if precheck else [tasks]
+    for n, tier in enumerate(tiers):
+        # plain tasks of all entities are shared between execute requests
+        calls = [(uid, key) for uid in alive for key in tier if key not in DELEGATES]
+        for chunk in make_chunks(calls, EXECUTE_LIMIT):
+            try:
+                results = run([(tasks[key]['method'], prepare(uid, entity_type, tasks[key])) for uid, key in chunk])
+            except (RequestException, vk_api.VkApiError) as e:
+                results = [e] * len(chunk)
+            for (uid, key), result in zip(chunk, results):
+                if not isinstance(result, Exception):
+                    data[uid][key] = extract(result, tasks[key])
+                elif is_transient(result):
+                    errors[uid][key] = get_code(result)
+
+        # delegates page through their own calls, so they are batched per entity
+        for uid in alive:
+            for key, task in tier.items():
+                if key in DELEGATES:
+                    try:
+                        data[uid][key] = resolve(run, uid, entity_type, key, task, data[uid])
+                    except (RequestException, vk_api.VkApiError) as e:
+                        if is_transient(e):
+                            errors[uid][key] = get_code(e)
+        for uid in alive:
+            if errors[uid]:
+                defer_rest(errors[uid], tiers, n)
+        alive = [uid for uid in alive if not errors[uid] and (not precheck or check_keys(data[uid], entity_type, tier))]
+
+    deferred = {uid: Deferred(data[uid], errors[uid]) for uid in uids if errors[uid]}
+    for uid in uids:
+        if uid not in deferred:
+            save(uid, entity_type, data[uid])
+            if journal:
+                journal.done(uid)
+    return deferred
@@ -0,0 +1,238 @@
+import bisect
+import cProfile
+import glob
+import json
+import logging
+import multiprocessing.util
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Tuple
+
+from fetcher import DATA_PATH
+
+# every process dumps its own snapshot, snapshots are merged on export
+METRICS_PATH = DATA_PATH / 'metrics'
+PROFILES_PATH = DATA_PATH / 'profiles'
+# upper bounds of latency buckets in seconds
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., float('inf')]
+# how often snapshots are flushed, in seconds
+FLUSH_FREQ = 5.
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Registry:
+    """Metrics of the current process"""
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters: Dict[Key, float] = defaultdict(float)
+        self.gauges: Dict[Key, float] = {}
+        # buckets, sum and count of every histogram
+        self.histograms: Dict[Key, list] = {}
+        self.flusher = None
+
+    def start(self) -> None:
+        """Starts flushing snapshots of the process, the last one is flushed when the process exits"""
+        if self.flusher is not None:
+            return
+
+        def flush():
+            while True:
+                time.sleep(FLUSH_FREQ)
+                self.flush()
+
+        self.flusher = threading.Thread(target=flush, daemon=True)
+        self.flusher.start()
+        multiprocessing.util.Finalize(self, self.flush, kwargs={'final': True}, exitpriority=10)
+
+    def snapshot(self, final=False) -> Dict:
+        with self.lock:
+            return {
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                # gauges describe a living process only
+                'gauges': [] if final else [[name, dict(labels), value] for (name, labels), value in self.gauges.items()],
+                'histograms': [[name, dict(labels), *value] for (name, labels), value in self.histograms.items()]
+            }
+
+    def flush(self, final=False) -> None:
+        # the data folder is not recreated once it has been removed, e.g. by a benchmark cleaning up after itself
+        if not DATA_PATH.exists():
+            return
+        file = METRICS_PATH / f'{os.getpid()}.json'
+        tmp = file.with_suffix('.tmp')
+        try:
+            METRICS_PATH.mkdir(exist_ok=True)
+            tmp.write_text(json.dumps(self.snapshot(final)))
+            os.replace(tmp, file)
+        except FileNotFoundError:
+            # the data folder has been removed while flushing
+            pass
+
+
+registry = Registry()
+
+
+def reset_registry() -> None:
+    # a forked process starts with empty metrics, otherwise metrics of its parent are counted twice
+    global registry
+    registry = Registry()
+
+
+os.register_at_fork(after_in_child=reset_registry)
+
+
+def get_key(name: str, labels: Dict) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    registry.start()
+    with registry.lock:
+        registry.counters[get_key(name, labels)] += value
+
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    registry.start()
+    with registry.lock:
+        registry.gauges[get_key(name, labels)] = value
+
+
+def observe(name: str, value: float, **labels) -> None:
+    registry.start()
+    with registry.lock:
+        buckets, total, count = registry.histograms.get(get_key(name, labels), ([0] * len(BUCKETS), 0., 0))
+        buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        registry.histograms[get_key(name, labels)] = [buckets, total + value, count + 1]
+
+
+@contextmanager
+def timed(name: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def clear() -> None:
+    """Removes snapshots of previous runs"""
+    shutil.rmtree(METRICS_PATH, ignore_errors=True)
+
+
+def collect() -> Dict[str, Dict[Key, object]]:
+    """Merges snapshots of all processes"""
+    registry.flush()
+    merged = {'counters': defaultdict(float), 'gauges': defaultdict(float), 'histograms': {}}
+    for file in glob.glob(str(METRICS_PATH / '*.json')):
+        try:
+            with open(file) as f:
+                snapshot = json.load(f)
+        except (OSError, json.decoder.JSONDecodeError):
+            continue
+        for kind in ['counters', 'gauges']:
+            for name, labels, value in snapshot[kind]:
+                merged[kind][get_key(name, labels)] += value
+        for name, labels, buckets, total, count in snapshot['histograms']:
+            key = get_key(name, labels)
+            previous = merged['histograms'].get(key, ([0] * len(BUCKETS), 0., 0))
+            merged['histograms'][key] = ([a + b for a, b in zip(previous[0], buckets)], previous[1] + total,
+                                         previous[2] + count)
+    return merged
+
+
+def format_labels(labels, **extra) -> str:
+    labels = [*labels, *extra.items()]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}' if labels else ''
+
+
+def render(metrics) -> str:
+    """Renders metrics in the text format of Prometheus"""
+    lines = []
+    for kind, prometheus_type in [('counters', 'counter'), ('gauges', 'gauge')]:
+        for name in sorted({name for name, _ in metrics[kind]}):
+            lines.append(f'# TYPE {name} {prometheus_type}')
+            lines += [f'{n}{format_labels(labels)} {value:g}' for (n, labels), value in metrics[kind].items() if n == name]
+    for name in sorted({name for name, _ in metrics['histograms']}):
+        lines.append(f'# TYPE {name} histogram')
+        for (n, labels), (buckets, total, count) in metrics['histograms'].items():
+            if n != name:
+                continue
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f'{name}_bucket{format_labels(labels, le="+Inf" if bound == float("inf") else bound)} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total:g}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+    return '\n'.join(lines) + '\n'
+
+
+def export(file: Path = DATA_PATH / 'metrics.prom') -> None:
+    tmp = file.with_suffix('.tmp')
+    tmp.write_text(render(collect()))
+    os.replace(tmp, file)
+
+
+def start_exporter(port: int = None, freq: float = 10.) -> None:
+    """Periodically writes merged metrics into a file and optionally serves them over http"""
+
+    def write():
+        while True:
+            time.sleep(freq)
+            export()
+
+    threading.Thread(target=write, daemon=True).start()
+    if port:
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = render(collect()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logging.info(f'metrics: serving on http://localhost:{port}/metrics')
+
+
+@contextmanager
+def stage(name: str, profile: str = None):
+    """Measures duration of a pipeline stage, optionally profiling it with cProfile or py-spy"""
+    PROFILES_PATH.mkdir(parents=True, exist_ok=True)
+    profiler, spy = None, None
+    if profile == 'cprofile':
+        # only the main process is profiled
+        profiler = cProfile.Profile()
+        profiler.enable()
+    elif profile == 'py-spy':
+        if shutil.which('py-spy'):
+            spy = subprocess.Popen(['py-spy', 'record', '--pid', str(os.getpid()), '--subprocesses',
+                                    '-o', str(PROFILES_PATH / f'{name}.svg')])
+        else:
+            logging.warning('metrics: py-spy is not installed, skipping profiling')
+    start = time.time()
+    try:
+        yield
+    finally:
+        set_gauge('stage_seconds', time.time() - start, stage=name)
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(PROFILES_PATH / f'{name}.prof')
+        if spy:
+            spy.send_signal(signal.SIGINT)
+            spy.wait()
+        export()
@@ -1,92 +1,182 @@
 import logging
+import os
 import re
-from functools import partial
-from typing import List
+from typing import Any, Dict, Iterator, List, Tuple, Union
 
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 
-from fetcher.transform import transform as t
-from fetcher.utils import discover, flatten, load
+from fetcher import ML_PATH
+from fetcher.index import IdLog, lookup
+from fetcher.transform import LIST_COLUMNS, TEXTS, squash
+from fetcher.utils import discover, load, exists, get_file, get_manifest, Writer, Matrix, Graph
 
 
-def load_and_transform(entity_type, transform: lambda arg: arg) -> List:
+def get_state(entity_type, version: str) -> IdLog:
+    """Log of bundles rows of outputs were taken from, outputs built by another model are not reused"""
+    return IdLog(ML_PATH / f'{entity_type}-{version}.idx')
+
+
+def reset_state(entity_type) -> None:
+    for file in ML_PATH.glob(f'{entity_type}-*.idx'):
+        os.remove(file)
+
+
+def get_changes(entity_type, state: IdLog) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns sorted ids of entities merged into other bundles since outputs were built and their bundles"""
+    ids, bundles = get_manifest(entity_type).read()
+    changed = bundles != lookup(ids, *state.read(), default=-1)
+    return ids[changed], bundles[changed]
+
+
+def read_bundle(chunk, entity_type, columns: List[str]) -> pd.DataFrame:
+    """Reads the given columns of a bundle, columns the bundle does not have are skipped"""
     bundle_type = f'bundle-{entity_type}'
-    return flatten(map(transform, load(chunk, bundle_type)) for chunk in discover(bundle_type))
+    names = pq.read_schema(get_file(chunk, bundle_type)).names
+    # bundles merged before texts were stored have them normalized from raw posts
+    if TEXTS in columns and TEXTS not in names and entity_type == 'user':
+        columns = [*columns, 'posts']
+    return load(chunk, bundle_type, columns=[name for name in columns if name in names])
 
 
-def to_df(entity_type):
-    entities = load_and_transform(entity_type, partial(t, entity_type=entity_type))
-    if len(entities):
-        df = pd.json_normalize(entities)
-        df.drop_duplicates(subset='id', keep='last', inplace=True)
-        df.set_index(keys='id', drop=True, inplace=True)
-        logging.info(f'ml: created dataframe with {len(df)} {entity_type}s')
-        return df
-    else:
-        logging.warning(f'ml: no suitable {entity_type}s found')
+def iter_bundles(entity_type, changes: Tuple[np.ndarray, np.ndarray], columns: List[str]) -> Iterator[pd.DataFrame]:
+    """Reads bundles of changed entities one by one, other rows of the bundles are skipped"""
+    ids, bundles = changes
+    for chunk in tqdm(np.unique(bundles[bundles >= 0]).tolist()):
+        df = read_bundle(chunk, entity_type, columns)
+        yield df[lookup(df.id.to_numpy(), ids, bundles, default=-1) == chunk]
+
 
+def merge_types(a: pa.DataType, b: pa.DataType) -> pa.DataType:
+    if a == b or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+    if all(pa.types.is_integer(t) or pa.types.is_floating(t) or pa.types.is_boolean(t) for t in [a, b]):
+        return pa.float64()
+    return pa.string()
 
-def get_text_filtering_func(lang='ru'):
-    expr = {'ru': r'[А-я]+', 'eng': r'[A-z]+'}[lang]
-    return lambda x: ' '.join(re.findall(expr, x.lower()))
 
+def get_social_schema(entity_type) -> pa.Schema:
+    """Unifies schemas of all bundles except for the list columns"""
+    bundle_type = f'bundle-{entity_type}'
+    types = {}
+    for chunk in discover(bundle_type):
+        for field in pq.read_schema(get_file(chunk, bundle_type)):
+            if field.name not in LIST_COLUMNS[entity_type]:
+                types[field.name] = merge_types(types.get(field.name, pa.null()), field.type)
+    return pa.schema(sorted(types.items()))
 
-def extract_group_data(model):
-    # social df
-    df = to_df('group')
-    if df is None:
-        return
-    yield 'group_social.pd', df
 
-    if model:
-        # posts
-        filter_text = get_text_filtering_func()
-        embeddings = []
-        for uid, text in tqdm(zip(df.index, df.text), total=len(df)):
-            partial_embeddings = [model.get_sentence_vector(filter_text(part)) for part in text.split('\n')]
-            assert len(partial_embeddings) >= 3
-            embeddings.append({'id': uid, 'emb': np.mean(np.stack(partial_embeddings), axis=0)})
-        yield 'group2post_embedding.dict', pd.DataFrame.from_records(embeddings, index='id')
-        del df, embeddings
-    else:
-        logging.warning('ml: skipping group2post embedding')
-
-
-def extract_user_data(model):
-    # social df
-    df = to_df('user')
-    if df is None:
-        return
-    yield 'user_social.pd', df
-    del df
-
-    # dicts of groups and friends
-    fields = ['groups', 'friends']
-    for field in fields:
-        entities = load_and_transform('user', lambda r: {'id': r['user']['id'], field: r[field]})
-        if entities:
-            yield f'user2{field}.dict', pd.DataFrame.from_records(entities, index='id')
-        del entities
-
-    # posts
-    if model:
-        filter_text = get_text_filtering_func()
-        embeddings = []
-        posts_collection = dict(load_and_transform('user', lambda obj: (obj['user']['id'], obj['posts'])))
-        for uid, posts in tqdm(posts_collection.items()):
-            user_posts = set([p['text'] for p in posts])
-            partial_embeddings = []
-            for post in user_posts:
-                if len(' '.join(post.split())) > 30:
-                    partial_embeddings.append(model.get_sentence_vector(filter_text(' '.join(post.split()))))
-            assert len(partial_embeddings) >= 2
-            embeddings.append({'id': uid, 'emb': np.mean(np.stack(partial_embeddings), axis=0)})
-        yield 'user2text_embedding.dict', pd.DataFrame.from_records(embeddings, index='id')
+def get_columns(entity_type, embedder=None) -> List[str]:
+    """Returns columns of bundles outputs are built from, e.g. members of groups are never read"""
+    columns = ['id', *get_social_schema(entity_type).names]
+    if entity_type == 'user':
+        columns += ['groups', 'friends']
+    if embedder:
+        columns.append(TEXTS)
+    return list(dict.fromkeys(columns))
+
+
+WORDS = {'ru': re.compile(r'[А-я]+'), 'eng': re.compile(r'[A-z]+')}
+
+
+def get_bundle_texts(df, entity_type) -> pd.Series:
+    """Normalized texts of a bundle, bundles merged before they were stored are normalized here"""
+    if TEXTS in df.columns:
+        return df[TEXTS]
+    if entity_type == 'user':
+        return df.posts.map(lambda posts: list(dict.fromkeys(squash(post) for post in posts)))
+    return df.text.str.split('\n')
+
+
+def filter_texts(texts: pd.Series, lang='ru', min_length=0) -> List[List[str]]:
+    """Filters texts of a whole bundle at once, texts not longer than `min_length` are skipped"""
+    texts = texts.reset_index(drop=True)
+    parts = texts.explode().dropna()
+    parts = parts[parts.str.len() > min_length] if min_length else parts
+    words = parts.str.lower().str.findall(WORDS[lang]).str.join(' ').groupby(level=0).agg(list)
+    return [words.get(i, []) for i in range(len(texts))]
+
+
+def embed(df, embedder, entity_type) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns ids of entities having texts and their embeddings, only meaningful posts of users are embedded"""
+    texts = filter_texts(get_bundle_texts(df, entity_type), min_length=30 if entity_type == 'user' else 0)
+    mask, embeddings = embedder.embed(texts)
+    return df.id.to_numpy()[mask], embeddings
+
+
+EMBEDDINGS = {'user': 'user2text_embedding', 'group': 'group2post_embedding'}
+
+
+def get_adjacency(df, field) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns ids of entities, lengths of their lists of related ids and all the related ids"""
+    lengths = df[field].map(len).to_numpy()
+    related = np.concatenate([np.empty(0, np.int64), *df[field]]) if len(df) else np.empty(0, np.int64)
+    return df.id.to_numpy(), lengths, related
+
+
+def count_rows(entity_type, bundles: np.ndarray) -> int:
+    bundle_type = f'bundle-{entity_type}'
+    return sum(pq.read_metadata(get_file(chunk, bundle_type)).num_rows for chunk in np.unique(bundles[bundles >= 0]))
+
+
+def get_output_names(entity_type, embedder=None) -> Dict[str, str]:
+    """Returns names of outputs and their entity types"""
+    names = {f'{entity_type}_social.pd': f'df-{entity_type}'}
+    if entity_type == 'user':
+        names.update({f'user2{field}': f'graph-{entity_type}' for field in ['groups', 'friends']})
+    if embedder:
+        names[EMBEDDINGS[entity_type]] = f'emb-{entity_type}'
+    return names
+
+
+# writers of outputs of the ML stage
+Output = Union[Writer, Matrix, Graph]
+
+
+def get_outputs(entity_type, changes: Tuple[np.ndarray, np.ndarray], embedder=None) -> Dict[str, Output]:
+    """Returns writers of dataframes and arrays extracted from bundles"""
+    df_type = f'df-{entity_type}'
+    outputs = {f'{entity_type}_social.pd': Writer(f'{entity_type}_social.pd', df_type, get_social_schema(entity_type))}
+    if entity_type == 'user':
+        for field in ['groups', 'friends']:
+            outputs[f'user2{field}'] = Graph(f'user2{field}', f'graph-{entity_type}')
+    if embedder:
+        name = EMBEDDINGS[entity_type]
+        # rows are preallocated for previous embeddings and all rows of bundles that are read
+        emb_type = f'emb-{entity_type}'
+        previous = len(load(name, emb_type)[0]) if exists(name, emb_type) else 0
+        outputs[name] = Matrix(name, emb_type, previous + count_rows(entity_type, changes[1]), embedder.dim)
     else:
-        logging.warning('ml: skipping user2text embedding')
+        logging.warning(f'ml: skipping {entity_type} embeddings')
+    return outputs
+
+
+def extract_group_data(changes, embedder) -> Iterator[Tuple[str, Any]]:
+    for df in iter_bundles('group', changes, get_columns('group', embedder)):
+        # social df
+        yield 'group_social.pd', df.drop(columns=LIST_COLUMNS['group'], errors='ignore').set_index('id')
+        # posts
+        if embedder:
+            yield EMBEDDINGS['group'], embed(df, embedder, 'group')
+
+
+def extract_user_data(changes, embedder) -> Iterator[Tuple[str, Any]]:
+    for df in iter_bundles('user', changes, get_columns('user', embedder)):
+        # social df
+        yield 'user_social.pd', df.drop(columns=LIST_COLUMNS['user'], errors='ignore').set_index('id')
+        # adjacency matrices of groups and friends
+        for field in ['groups', 'friends']:
+            yield f'user2{field}', get_adjacency(df, field)
+        # posts
+        if embedder:
+            yield EMBEDDINGS['user'], embed(df, embedder, 'user')
 
 
-def extract_data(entity_type, model=None):
-    return {'user': extract_user_data, 'group': extract_group_data}[entity_type](model)
+def extract_data(entity_type, changes: Tuple[np.ndarray, np.ndarray], embedder=None) -> Iterator[Tuple[str, Any]]:
+    """Reads every bundle of changed entities once and yields chunks of all outputs extracted from it"""
+    return {'user': extract_user_data, 'group': extract_group_data}[entity_type](changes, embedder)
@@ -0,0 +1,287 @@
+import heapq
+import logging
+import math
+import time
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Set, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from fetcher import PARTIAL_PATH, metrics
+from fetcher.index import Journal
+from fetcher.methods import fetch, fetch_many, get_chunk_size
+from fetcher.responses import ResponseCache
+from fetcher.retry import DEFER_ROUNDS, Deferred, defer_delay, give_up
+from fetcher.utils import candidates_needed, make_sample, missing, verify, rng
+
+# how often fetched entities are verified and handed to downstream stages, in seconds,
+# every check reads whole id logs, so entities are checked in batches
+FLUSH_FREQ = 1.
+# how many times an entity is fetched again when its worker fails
+ATTEMPTS = 3
+
+
+class Stage:
+    """Stage of todo.yml, ids of a dependent stage are sampled from entities of its upstream stage"""
+
+    def __init__(self, key: str, stage: Dict, tasks: Dict[str, Dict]) -> None:
+        self.key = key
+        self.entity_type = stage['type']
+        self.tasks = tasks
+        self.chunk_size = get_chunk_size(tasks)
+        self.source = stage['ids'] if isinstance(stage['ids'], dict) else None
+        # number of entities passing the check the stage needs, candidates are dropped once it is reached
+        self.target = stage.get('target')
+        self.journal = Journal(PARTIAL_PATH / f'journal-{key}.idx')
+        # entities in flight when the previous run was interrupted are fetched again
+        self.in_flight = set(self.journal.pending().tolist())
+        self.ids: Set[int] = set()
+        self.verified: Set[int] = set()
+        # ids waiting for a free worker
+        self.queue = deque()
+        # number of ids being fetched, by this stage or by another stage of the same type
+        self.pending = 0
+        # number of ids being fetched by workers of this stage
+        self.running = 0
+        # fetched ids which are not verified yet
+        self.fetched: List[int] = []
+        # entities with failed tasks by the time of their next round, they are retried once the queue is empty
+        self.deferred: List[Tuple[float, int, int, Deferred]] = []
+        self.checked = 0
+        # ids of the upstream stage a sample is drawn from once the upstream stage is done
+        self.sources: Set[int] = set()
+        self.consumers: List['Stage'] = []
+        self.upstream = None
+        self.started = time.time()
+        self.done = False
+
+    @property
+    def streaming(self) -> bool:
+        # a sample of the union of all lists needs all lists, while per entity samples and full lists add up
+        return self.source is None or self.source.get('per_entity', False) or self.source['count'] == -1
+
+    @property
+    def satisfied(self) -> bool:
+        return bool(self.target) and len(self.verified) >= self.target
+
+    def budget(self, window: int) -> float:
+        """Number of ids the stage may start fetching, a stage with a target fetches about as many as it needs"""
+        if not self.target:
+            return math.inf
+        # rejected candidates are saved first, so checks are trusted once about a window of candidates is checked
+        return candidates_needed(self.target, len(self.verified), self.checked, window) - self.running - \
+            len(self.fetched)
+
+    def sample(self, source: Set[int]) -> Set[int]:
+        return make_sample(self.upstream.entity_type, self.entity_type, self.source['count'], source,
+                           self.source.get('per_entity', False))
+
+
+class Pipeline:
+    """
+    Runs all stages on a shared pool of processes and a shared token pool.
+    Entities of a stage are handed to dependent stages as soon as they are fetched and verified,
+    so downstream stages keep workers busy while upstream stages finish.
+    """
+
+    def __init__(self, stages: Dict[str, Stage], token_manager, batch=False, workers=32,
+                 cache: ResponseCache = None) -> None:
+        self.stages = stages
+        self.token_manager = token_manager
+        self.cache = cache
+        self.batch = batch
+        self.workers = workers
+        # stages waiting for an entity being fetched, an entity is fetched once even if several stages need it
+        self.owners: Dict[str, Dict[int, List[Stage]]] = defaultdict(dict)
+        self.futures = {}
+        self.attempts = Counter()
+        self.progress = None
+
+    def add(self, stage: Stage, ids: Set[int]) -> None:
+        """Schedules ids of the stage, stored entities are passed through at once"""
+        ids = set(ids) - stage.ids
+        if not ids or stage.satisfied:
+            return
+        stage.ids |= ids
+        owners = self.owners[stage.entity_type]
+        shared = {uid for uid in ids if uid in owners}
+        for uid in shared:
+            owners[uid].append(stage)
+        rest = ids - shared
+        to_fetch = missing(rest, stage.entity_type) | (rest & stage.in_flight)
+        for uid in to_fetch:
+            owners[uid] = [stage]
+        stage.fetched += rest - to_fetch
+        if stage.target:
+            # candidates are drawn at random until the target is reached
+            to_fetch = rng.permutation(np.fromiter(to_fetch, np.int64, len(to_fetch))).tolist()
+        stage.queue.extend(to_fetch)
+        stage.pending += len(shared) + len(to_fetch)
+        self.progress.total += len(to_fetch)
+        self.progress.refresh()
+
+    def submit(self, executor: ProcessPoolExecutor) -> None:
+        """Keeps every worker busy, upstream stages go first since dependent stages are sampled from them"""
+        window = 2 * self.workers
+        while len(self.futures) < window:
+            now = time.time()
+            stage = next((s for s in self.stages.values() if s.queue and s.budget(window) > 0
+                          or not s.queue and s.deferred and s.deferred[0][0] <= now), None)
+            if stage is None:
+                break
+            # entities of a stage with a target are rejected as soon as a fetched key fails the check
+            precheck = bool(stage.target)
+            attempt = 0
+            if not stage.queue:
+                _, attempt, uid, retry = heapq.heappop(stage.deferred)
+                chunk = [uid]
+                future = executor.submit(fetch, uid, stage.entity_type, stage.tasks, self.token_manager,
+                                         batch=self.batch, journal=stage.journal, precheck=precheck,
+                                         cache=self.cache, retry=retry)
+            elif self.batch:
+                chunk = [stage.queue.popleft() for _ in range(min(stage.chunk_size, len(stage.queue)))]
+                future = executor.submit(fetch_many, chunk, stage.entity_type, stage.tasks, self.token_manager,
+                                         journal=stage.journal, precheck=precheck, cache=self.cache)
+            else:
+                chunk = [stage.queue.popleft()]
+                future = executor.submit(fetch, chunk[0], stage.entity_type, stage.tasks, self.token_manager,
+                                         journal=stage.journal, precheck=precheck, cache=self.cache)
+            stage.running += len(chunk)
+            self.futures[future] = (stage, chunk, attempt)
+        metrics.set_gauge('fetch_queue_depth', sum(len(s.queue) for s in self.stages.values()))
+
+    def defer(self, stage: Stage, deferred: Dict[int, Deferred], attempt: int) -> List[int]:
+        """Schedules the next round of entities with failed tasks, returns entities which are out of rounds"""
+        if attempt >= DEFER_ROUNDS:
+            give_up(stage.key, stage.entity_type, deferred, stage.journal)
+            return list(deferred)
+        for uid, retry in deferred.items():
+            heapq.heappush(stage.deferred, (time.time() + defer_delay(attempt), attempt + 1, uid, retry))
+        return []
+
+    def retry(self, stage: Stage, chunk: List[int]) -> List[int]:
+        """Queues entities of a failed chunk again, returns entities which are saved or out of attempts"""
+        failed = missing(chunk, stage.entity_type)
+        self.attempts.update(failed)
+        # entities out of attempts are left in the journal and fetched next run
+        retried = {uid for uid in failed if self.attempts[uid] < ATTEMPTS}
+        stage.queue.extend(retried)
+        return [uid for uid in chunk if uid not in retried]
+
+    def complete(self, stage: Stage, chunk: List[int]) -> None:
+        for uid in chunk:
+            for owner in self.owners[stage.entity_type].pop(uid):
+                owner.pending -= 1
+                owner.fetched.append(uid)
+        self.progress.update(len(chunk))
+
+    def flush(self, stage: Stage, force: bool = False) -> None:
+        """Verifies fetched entities of the stage and passes them downstream"""
+        if not stage.fetched or not (force or stage.pending == 0):
+            return
+        fetched, stage.fetched = set(stage.fetched), []
+        verified = verify(fetched, stage.entity_type)
+        stage.verified |= verified
+        stage.checked += len(fetched)
+        if stage.satisfied and stage.queue:
+            self.drop(stage)
+        for consumer in stage.consumers:
+            source = verified if consumer.source.get('only_verified') else fetched
+            if consumer.streaming:
+                self.add(consumer, consumer.sample(source))
+            else:
+                consumer.sources |= source
+
+    def drop(self, stage: Stage) -> None:
+        """Drops queued candidates of a stage which has reached its target"""
+        logging.info(f'stage({stage.key}): {len(stage.verified)} out of {stage.target} entities OK, '
+                     f'{len(stage.queue)} candidates are left')
+        owners = self.owners[stage.entity_type]
+        for uid in stage.queue:
+            owners[uid].remove(stage)
+            stage.pending -= 1
+            stage.ids.discard(uid)
+            if owners[uid]:
+                # another stage still needs the entity
+                owners[uid][0].queue.append(uid)
+            else:
+                del owners[uid]
+                self.progress.total -= 1
+        stage.queue.clear()
+
+    def finish(self, stage: Stage) -> None:
+        if stage.done or stage.pending or stage.fetched or (stage.upstream and not stage.upstream.done):
+            return
+        stage.done = True
+        # all entities are saved, the journal is no longer needed
+        stage.journal.compact(drop=0)
+        logging.info(f'check({stage.key}): {len(stage.verified)} out of {len(stage.ids)} entities OK')
+        if stage.target and not stage.satisfied:
+            logging.warning(f'check({stage.key}): candidates are exhausted before reaching {stage.target} entities')
+        damaged = missing(stage.ids, stage.entity_type)
+        if damaged:
+            logging.warning(f'check({stage.key}): {len(damaged)} entities are missing, they are fetched next run')
+        logging.info(f'stage({stage.key}): completed in {time.time() - stage.started:.2f} seconds')
+        for consumer in stage.consumers:
+            if not consumer.streaming:
+                logging.info(f'stage({consumer.key}): sampling from {len(consumer.sources)} {stage.entity_type}s')
+                self.add(consumer, consumer.sample(consumer.sources))
+
+    def run(self, ids: Dict[str, Set[int]]) -> None:
+        # workers lease their tokens once and keep them for all stages
+        self.token_manager.renew()
+        with tqdm(total=0) as self.progress, ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for key, stage_ids in ids.items():
+                self.add(self.stages[key], stage_ids)
+            flushed = time.time()
+            while not all(stage.done for stage in self.stages.values()):
+                self.submit(executor)
+                if not self.futures:
+                    # only deferred entities are left, they wait for their round
+                    time.sleep(FLUSH_FREQ)
+                done, _ = wait(self.futures, timeout=FLUSH_FREQ, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, chunk, attempt = self.futures.pop(future)
+                    stage.running -= len(chunk)
+                    try:
+                        deferred = future.result()
+                        chunk = [uid for uid in chunk if uid not in deferred] + self.defer(stage, deferred, attempt)
+                    except BrokenProcessPool:
+                        raise
+                    except Exception:
+                        logging.exception(f'fetch({stage.key}): failed to fetch {stage.entity_type}s {chunk}')
+                        chunk = self.retry(stage, chunk)
+                    self.complete(stage, chunk)
+                force = time.time() - flushed > FLUSH_FREQ
+                if force:
+                    flushed = time.time()
+                # stages are listed in todo order, so a chain of finished stages is resolved at once
+                for stage in self.stages.values():
+                    self.flush(stage, force)
+                    self.finish(stage)
+
+
+def make_stages(todo: Dict, tasks: Dict[str, Dict[str, Dict]]) -> Tuple[Dict[str, Stage], Dict[str, Set[int]]]:
+    """Links stages of todo.yml to their upstream stages, returns them with ids of stages without upstream"""
+    stages = {key: Stage(key, stage, tasks[key]) for key, stage in todo.items()}
+    ids = {}
+    for stage in stages.values():
+        if stage.source is None:
+            ids[stage.key] = {todo[stage.key]['ids']} if isinstance(todo[stage.key]['ids'], int) \
+                else set(todo[stage.key]['ids'])
+            continue
+        stage.upstream = stages[stage.source['from']]
+        stage.upstream.consumers.append(stage)
+        mode = 'streaming' if stage.streaming else 'waiting for the whole sample'
+        logging.info(f'stage({stage.key}): {mode} from {stage.upstream.key}')
+    return stages, ids
+
+
+def run_pipeline(todo: Dict, tasks: Dict[str, Dict[str, Dict]], token_manager, batch=False, workers=32,
+                 cache: ResponseCache = None) -> None:
+    """Runs stages of todo.yml as a pipeline, a stage may only depend on the stages listed before it"""
+    stages, ids = make_stages(todo, tasks)
+    Pipeline(stages, token_manager, batch, workers, cache).run(ids)
@@ -1,37 +1,43 @@
 import logging
-import sys
+import math
 import time
+from contextlib import nullcontext
 from functools import partial
 from pathlib import Path
 from timeit import default_timer as timer
-from typing import Dict, Set
+from typing import Dict, List, Set, Tuple
 
 import fasttext as fasttext
+import numpy as np
 import yaml
 from tqdm.contrib.concurrent import process_map
 
-from fetcher import PREFIX
-from fetcher.exceptions import DamagedEntitiesFoundError
-from fetcher.methods import fetch
-from fetcher.ml import extract_data
+from fetcher import PREFIX, PARTIAL_PATH, STORAGE, metrics
+from fetcher.aio import fetch_all
+from fetcher.embeddings import Embedder, EmbeddingCache, get_fingerprint
+from fetcher.index import Journal
+from fetcher.methods import fetch, fetch_many, get_chunk_size, project_task
+from fetcher.ml import extract_data, get_outputs, get_output_names, get_state, reset_state, get_changes, \
+    EMBEDDINGS
+from fetcher.pipeline import run_pipeline
+from fetcher.responses import ResponseCache, get_response_cache
+from fetcher.retry import DEFER_ROUNDS, Deferred, defer_delay, give_up
+from fetcher.transform import SCHEMA
+from fetcher.similarity import build_index, query
 from fetcher.tokens import get_token_manager
-from fetcher.utils import deep_merge, flatten, sample, load, discover, dump_chunks, verify, save
+from fetcher.utils import candidates_needed, deep_merge, make_sample, rng, dump_chunks, verify, make_chunks, migrate, missing, exists
 
+# number of processes fetching entities
+WORKERS = 32
 
-def make_sample(consume: str, produce: str, size: int, source: Set[int], per_entity: bool = False) -> Set[int]:
-    """Extracts data from previous stage and creates a sample based on ids from it"""
-    if consume == 'user':
-        key = 'friends' if produce == 'user' else 'groups'
-    else:
-        if produce == 'group':
-            raise AttributeError('Both consume and produce are groups')
-        key = 'members'
-
-    ids = filter(lambda x: bool(x), [load(uid, consume).get(key) for uid in source])
-    return set(flatten(map(partial(sample, size=size), ids)) if per_entity else sample(flatten(ids), size))
 
-
-def init_and_run(skip_fetcher=False, skip_merger=False, skip_ml=False, model_path=None):
+def init_and_run(skip_fetcher=False, skip_merger=False, skip_ml=False, model_path=None, batch=False,
+                 engine='process', concurrency=1000, queue_size=10000, migrate_storage=False,
+                 embedding_cache_size=1024, skip_index=False, clusters=0, metrics_port=None, profile=None,
+                 pipeline=False, response_cache_size=1024):
+    # metrics of previous runs are dropped, every process of this run dumps its own
+    metrics.clear()
+    metrics.start_exporter(metrics_port)
     # load settings and run script
     with open(PREFIX / 'todo.yml', 'r') as todo_yml:
         with open(PREFIX / 'fetcher' / 'methods.yml', 'r') as methods_yml:
@@ -43,26 +49,45 @@ def init_and_run(skip_fetcher=False, skip_merger=False, skip_ml=False, model_pat
                 if not methods:
                     raise RuntimeError('No methods specified!')
 
+                types = set(map(lambda stage: stage['type'], todo.values()))
+                if migrate_storage:
+                    if STORAGE == 'store':
+                        for entity_type in types:
+                            logging.info(f'run: moved {migrate(entity_type)} {entity_type}s into the record store')
+                    else:
+                        logging.warning('run: record store is disabled, set VK_STORAGE=store to migrate')
+
                 if not skip_fetcher:
                     # fetch all entities
                     logging.info('run: starting fetcher')
-                    run_fetcher(todo, methods)
+                    with metrics.stage('fetcher', profile):
+                        run_fetcher(todo, methods, batch=batch, engine=engine, concurrency=concurrency,
+                                    queue_size=queue_size, pipeline=pipeline,
+                                    response_cache_size=response_cache_size)
                 else:
                     logging.info('run: skipping fetcher')
 
-                types = set(map(lambda stage: stage['type'], todo.values()))
                 if not skip_merger:
                     # dump processed data
                     logging.info(f'run: starting merger on {types}')
-                    run_merger(types)
+                    with metrics.stage('merger', profile):
+                        run_merger(types)
                 else:
                     logging.info('run: skipping merger')
                 if not skip_ml:
                     # build embeddings
                     logging.info(f'run: starting ml on {types}')
-                    run_ml(types, model_path)
+                    with metrics.stage('ml', profile):
+                        run_ml(types, model_path, cache_size=embedding_cache_size)
                 else:
                     logging.info('run: skipping ml')
+                if not skip_index:
+                    # build similarity indexes
+                    logging.info(f'run: starting index on {types}')
+                    with metrics.stage('index', profile):
+                        run_index(types, clusters)
+                else:
+                    logging.info('run: skipping index')
 
                 logging.info('run: all done, exiting')
 
@@ -70,8 +95,87 @@ def init_and_run(skip_fetcher=False, skip_merger=False, skip_ml=False, model_pat
                 logging.exception('init: failed to load settings')
 
 
-def run_fetcher(todo: Dict, methods: Dict):
-    """Runs all the tasks"""
+def prepare_tasks(stage: Dict, methods: Dict) -> Dict[str, Dict]:
+    """Merges requests of the stage with their methods and projects them on the schema, cheaper requests go first"""
+    requests = stage['include']
+    for name, request in requests.items():
+        method = methods[name]
+        task = deep_merge(method, {'request': request if isinstance(request, dict) else dict()})
+        requests[name] = project_task(task, SCHEMA[stage['type']].get(name))
+    return dict(sorted(requests.items(), key=lambda item: item[1].get('cost', 1)))
+
+
+def refetch(item: Tuple[int, Deferred], **kwargs) -> Dict[int, Deferred]:
+    uid, retry = item
+    return fetch(uid, retry=retry, **kwargs)
+
+
+def collect_deferred(results: List[Dict[int, Deferred]]) -> Dict[int, Deferred]:
+    return {uid: retry for result in results for uid, retry in result.items()}
+
+
+def fetch_ids(ids: Set[int], entity_type, tasks: Dict[str, Dict], token_manager, journal: Journal, engine='process',
+              batch=False, concurrency=1000, queue_size=10000, precheck=False, cache: ResponseCache = None, key=None):
+    """Fetches entities, tasks failed by transient errors are fetched again in rounds once all entities are fetched"""
+    kwargs = dict(entity_type=entity_type, tasks=tasks, token_manager=token_manager, journal=journal,
+                  precheck=precheck, cache=cache)
+    if engine == 'async':
+        deferred = fetch_all(list(ids), concurrency=concurrency, queue_size=queue_size, batch=batch, **kwargs)
+    elif batch:
+        # fill execute requests with plain tasks of several entities
+        size = get_chunk_size(tasks)
+        token_manager.renew()
+        deferred = collect_deferred(process_map(partial(fetch_many, **kwargs), list(make_chunks(list(ids), size)),
+                                                max_workers=WORKERS, chunksize=1))
+    else:
+        # hand out fresh token leases to the new worker processes
+        token_manager.renew()
+        deferred = collect_deferred(process_map(partial(fetch, **kwargs), list(ids), max_workers=WORKERS,
+                                                chunksize=1))
+
+    for attempt in range(DEFER_ROUNDS):
+        if not deferred:
+            break
+        delay = defer_delay(attempt)
+        logging.info(f'fetch({key}): {len(deferred)} entities have failed tasks, retrying them in {delay:.1f} seconds')
+        time.sleep(delay)
+        if engine == 'async':
+            deferred = fetch_all(list(deferred), concurrency=concurrency, queue_size=queue_size, batch=batch,
+                                 retries=deferred, **kwargs)
+        else:
+            token_manager.renew()
+            deferred = collect_deferred(process_map(partial(refetch, batch=batch, **kwargs), list(deferred.items()),
+                                                    max_workers=WORKERS, chunksize=1))
+    give_up(key, entity_type, deferred, journal)
+
+
+def fetch_target(key: str, entity_type, ids: Set[int], missing_ids: Set[int], target: int, fetch_missing) -> Set[int]:
+    """
+    Fetches candidates in random waves until the target number of them pass the check, returns candidates considered.
+    Waves are sized by the share of candidates passed so far.
+    """
+    considered = ids - missing_ids
+    passed = len(verify(considered, entity_type))
+    queue = rng.permutation(np.fromiter(missing_ids, np.int64, len(missing_ids))).tolist()
+    while passed < target and queue:
+        size = max(WORKERS, math.ceil(candidates_needed(target, passed, len(considered), WORKERS)))
+        wave, queue = set(queue[:size]), queue[size:]
+        logging.info(f'fetch({key}): {passed} out of {target} entities OK, fetching {len(wave)} more candidates')
+        fetch_missing(wave)
+        considered |= wave
+        passed = len(verify(considered, entity_type))
+    if passed < target:
+        logging.warning(f'fetch({key}): candidates are exhausted, {passed} out of {target} entities OK')
+    logging.info(f'fetch({key}): {len(ids) - len(considered)} candidates are left')
+    return considered
+
+
+def run_fetcher(todo: Dict, methods: Dict, batch=False, engine='process', concurrency=1000, queue_size=10000,
+                pipeline=False, response_cache_size=1024):
+    """
+    Runs all the tasks, either on a pool of processes or on a single asyncio event loop.
+    With pipeline, stages run concurrently on a shared pool of processes instead of one after another.
+    """
     logging.info(f'fetcher: upcoming stages - {list(todo.keys())}')
     logging.info(f'fetcher: methods allowed - {list(methods.keys())}')
 
@@ -83,7 +187,17 @@ def run_fetcher(todo: Dict, methods: Dict):
 
     ids_store = {}
     verified_ids_store = {}
-    token_manager = get_token_manager()
+    token_manager = get_token_manager(workers=1 if engine == 'async' else WORKERS)
+    # responses are shared by stages and runs
+    cache = get_response_cache(methods, response_cache_size << 20)
+
+    if pipeline:
+        if engine == 'process':
+            run_pipeline(todo, {key: prepare_tasks(stage, methods) for key, stage in todo.items()}, token_manager,
+                         batch=batch, workers=WORKERS, cache=cache)
+            logging.info('fetcher: all stages completed! Exiting')
+            return
+        logging.warning('fetcher: pipeline runs on the process engine only, running stages one after another')
 
     for key, stage in todo.items():
         start_time = timer()
@@ -107,41 +221,53 @@ def run_fetcher(todo: Dict, methods: Dict):
             raise RuntimeError('Failed to deduce ids')
         ids_store[key] = ids
 
-        # prepare tasks
-        requests = stage['include']
-        for name, request in requests.items():
-            method = methods[name]
-            requests[name] = deep_merge(method, {'request': request if isinstance(request, dict) else dict()})
+        requests = prepare_tasks(stage, methods)
+        target = stage.get('target')
+
+        # entities in flight when the previous run was interrupted are fetched again
+        journal = Journal(PARTIAL_PATH / f'journal-{key}.idx')
+        in_flight = set(journal.pending().tolist()) & ids
+        if in_flight:
+            logging.info(f'fetch({key}): {len(in_flight)} entities were in flight when interrupted')
 
         # find out what ids are missing
         while True:
             try:
-                cached_ids = discover(entity_type)
-                missing_ids = ids - cached_ids
+                missing_ids = missing(ids, entity_type) | in_flight
+                metrics.set_gauge('fetch_entities_missing', len(missing_ids), stage=key)
 
                 # get missing entities
-                if missing_ids:
+                fetch_missing = partial(fetch_ids, entity_type=entity_type, tasks=requests, token_manager=token_manager,
+                                        journal=journal, engine=engine, batch=batch, concurrency=concurrency,
+                                        queue_size=queue_size, precheck=bool(target), cache=cache, key=key)
+                if target:
+                    # candidates are drawn until enough of them pass the check
+                    ids = fetch_target(key, entity_type, ids, missing_ids, target, fetch_missing)
+                    ids_store[key] = ids
+                elif missing_ids:
                     logging.info(
                         f'fetch({key}): {len(ids) - len(missing_ids)} entities cached, {len(missing_ids)} to go')
-                    func = partial(fetch, entity_type=entity_type, tasks=requests, token_manager=token_manager)
-                    process_map(func, list(missing_ids), max_workers=32, chunksize=1)
+                    fetch_missing(missing_ids)
                 else:
                     logging.info(f'fetch({key}): already cached')
+                # all entities are saved, the journal is no longer needed
+                in_flight = set()
+                journal.compact(drop=0)
                 logging.info(f'check({key}): starting')
                 time.sleep(0.005)  # prevent progress bar being shown before logging kicks in
                 results = verify(ids, entity_type, track=True)
                 verified_ids_store[key] = results
                 logging.info(f'check({key}): {len(results)} out of {len(ids)} entities OK')
-                if ids - discover(entity_type):
-                    raise DamagedEntitiesFoundError(f'check({key}): some entities removed during checking')
+                damaged = missing(ids, entity_type)
+                if damaged:
+                    # files damaged before writes became atomic are removed by the check
+                    logging.warning(f'check({key}): {len(damaged)} damaged entities removed, they are fetched next run')
+                metrics.set_gauge('fetch_entities_missing', 0, stage=key)
+                metrics.set_gauge('fetch_stage_seconds', timer() - start_time, stage=key)
                 logging.info(f'stage({key}): completed in {timer() - start_time:.2f} seconds')
                 break
-            except (TypeError, DamagedEntitiesFoundError):
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                if exc_type is DamagedEntitiesFoundError:
-                    logging.warning(f'stage({key}): checker has found some damages entities')
-                else:
-                    logging.warning(f'stage({key}): a concurrent error occurred')
+            except TypeError:
+                logging.warning(f'stage({key}): a concurrent error occurred')
                 logging.info(f'stage({key}): restarting')
                 continue
     logging.info('fetcher: all stages completed! Exiting')
@@ -154,7 +280,7 @@ def run_merger(types):
     logging.info('merger: all done')
 
 
-def run_ml(types, model_path):
+def run_ml(types, model_path, cache_size=1024):
     # try to load model
     model = None
     if model_path:
@@ -167,10 +293,55 @@ def run_ml(types, model_path):
     else:
         logging.warning('ml: no model specified, some embeddings will be skipped')
 
-    for entity_type in types:
-        logging.info(f'ml: processing {entity_type}s')
-        for name, obj in extract_data(entity_type, model=model):
-            save(name, f'df-{entity_type}', obj)
-            logging.info(f'ml: dumped {name}')
+    # outputs built with another model are rebuilt from scratch
+    version = get_fingerprint(Path(model_path)) if model else 'none'
+    # vectors of texts seen in previous runs are taken from the cache
+    cache = None
+    if model and cache_size:
+        cache = EmbeddingCache(version, model.get_dimension(), cache_size << 20)
+
+    with (Embedder(model, cache=cache) if model else nullcontext()) as embedder:
+        for entity_type in types:
+            logging.info(f'ml: processing {entity_type}s')
+            state = get_state(entity_type, version)
+            outputs = get_output_names(entity_type, embedder)
+            rebuild = not state.exists() or not all(exists(name, output_type) for name, output_type in outputs.items())
+            if rebuild:
+                reset_state(entity_type)
+            changes = get_changes(entity_type, state)
+            if not len(changes[0]):
+                logging.info(f'ml: {entity_type}s are up to date')
+                continue
+            logging.info(f'ml: {len(changes[0])} {entity_type}s changed since the last run')
             time.sleep(0.005)  # prevent progress bar being shown before logging kicks in
+            writers = get_outputs(entity_type, changes, embedder=embedder)
+            if not rebuild:
+                # rows of unchanged entities are taken from previous outputs
+                for writer in writers.values():
+                    writer.keep(changes[0])
+            for name, chunk in extract_data(entity_type, changes, embedder=embedder):
+                writers[name].write(chunk)
+            for name, writer in writers.items():
+                writer.close()
+                if writer.rows:
+                    logging.info(f'ml: dumped {name} with {writer.rows} {entity_type}s')
+                else:
+                    logging.warning(f'ml: no suitable {entity_type}s found for {name}')
+            state.append(*changes)
     logging.info('ml: all done')
+
+
+def run_index(types, clusters=0):
+    for entity_type in types:
+        if not exists(EMBEDDINGS[entity_type], f'emb-{entity_type}'):
+            logging.warning(f'index: no {entity_type} embeddings found')
+            continue
+        logging.info(f'index: indexed {build_index(entity_type, clusters)} {entity_type}s')
+    logging.info('index: all done')
+
+
+def run_query(uids, source, target, top=10, nprobe=8):
+    for uid, neighbours in zip(uids, query(uids, source, target, top, nprobe)):
+        print(f'{source} {uid}:')
+        for neighbour, score in neighbours:
+            print(f'  {target} {neighbour}\t{score:.4f}')
@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+from typing import Dict, Optional
+
+from fetcher import CACHE_PATH, metrics
+
+# parameters which do not change a response
+IGNORED = {'access_token', 'v'}
+# how many responses a process puts between evictions
+EVICT_FREQ = 1000
+
+
+class ResponseCache:
+    """
+    Persistent cache of api responses keyed by method and request parameters, shared by all processes.
+    Responses expire after the ttl of their method, least recently used ones are evicted over `max_size` bytes.
+    Identical requests made concurrently within a process are sent once.
+    """
+
+    def __init__(self, ttls: Dict[str, float], max_size: int, file: Path = CACHE_PATH / 'responses.sqlite') -> None:
+        # seconds a response of a method stays valid, methods without ttl are not cached
+        self.ttls = ttls
+        self.max_size = max_size
+        self.file = file
+        self.pid = None
+
+    def __getstate__(self):
+        # connections and requests in flight belong to the process that made them
+        return {'ttls': self.ttls, 'max_size': self.max_size, 'file': self.file, 'pid': None}
+
+    def connect(self) -> None:
+        # forked processes open their own connection
+        if self.pid == os.getpid():
+            return
+        self.db = sqlite3.connect(str(self.file), timeout=60, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses '
+                        '(key BLOB PRIMARY KEY, response BLOB, expires REAL, used REAL)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self.db.commit()
+        self.lock = threading.Lock()
+        self.puts = 0
+        # futures of requests in flight, of threads and of coroutines
+        self.threads: Dict[bytes, Future] = {}
+        self.coroutines: Dict[bytes, asyncio.Future] = {}
+        self.pid = os.getpid()
+
+    def cacheable(self, method: str) -> bool:
+        return bool(self.ttls.get(method))
+
+    @staticmethod
+    def key(method: str, values: Dict) -> bytes:
+        # the api treats all parameters as strings
+        params = {k: str(v) for k, v in values.items() if k not in IGNORED}
+        return hashlib.md5((method + json.dumps(params, sort_keys=True, ensure_ascii=False)).encode()).digest()
+
+    def get(self, method: str, key: bytes) -> Optional[object]:
+        self.connect()
+        now = time.time()
+        with self.lock:
+            row = self.db.execute('SELECT response FROM responses WHERE key = ? AND expires > ?', (key, now)).fetchone()
+            if row:
+                self.db.execute('UPDATE responses SET used = ? WHERE key = ?', (now, key))
+                self.db.commit()
+        metrics.inc('response_cache_hits_total' if row else 'response_cache_misses_total', method=method)
+        return json.loads(row[0]) if row else None
+
+    def put(self, method: str, key: bytes, response) -> None:
+        self.connect()
+        now = time.time()
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                            (key, json.dumps(response, ensure_ascii=False).encode(), now + self.ttls[method], now))
+            self.puts += 1
+            if self.puts % EVICT_FREQ == 0:
+                self.evict(now)
+            self.db.commit()
+
+    def evict(self, now: float) -> None:
+        """Deletes expired responses and least recently used ones over the size limit"""
+        self.db.execute('DELETE FROM responses WHERE expires <= ?', (now,))
+        count, size = self.db.execute('SELECT COUNT(*), TOTAL(LENGTH(response)) FROM responses').fetchone()
+        if size > self.max_size:
+            # rows are assumed to be of the average size
+            excess = int(count * (1 - self.max_size / size)) + 1
+            self.db.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY used LIMIT ?)',
+                            (excess,))
+
+    def coalesce(self, method: str, key: bytes, make):
+        """Makes a request unless an identical one is in flight in another thread, then waits for its response"""
+        self.connect()
+        with self.lock:
+            future = self.threads.get(key)
+            owner = future is None
+            if owner:
+                future = self.threads[key] = Future()
+        if not owner:
+            metrics.inc('response_cache_coalesced_total', method=method)
+            return future.result()
+        try:
+            response = make()
+            if response is not None:
+                self.put(method, key, response)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.threads[key]
+
+    async def coalesce_async(self, method: str, key: bytes, make):
+        """Makes a request unless an identical one is in flight in another coroutine, then waits for its response"""
+        self.connect()
+        future = self.coroutines.get(key)
+        if future is not None:
+            metrics.inc('response_cache_coalesced_total', method=method)
+            return await asyncio.shield(future)
+        future = self.coroutines[key] = asyncio.get_event_loop().create_future()
+        try:
+            response = await make()
+            if response is not None:
+                self.put(method, key, response)
+            future.set_result(response)
+            return response
+        except BaseException as e:
+            future.set_exception(e)
+            # nobody might be waiting for the response
+            future.exception()
+            raise
+        finally:
+            del self.coroutines[key]
+
+
+def get_response_cache(methods: Dict[str, Dict], max_size: int) -> Optional[ResponseCache]:
+    """Returns a cache of responses of methods with a ttl, `max_size` is in bytes and 0 disables the cache"""
+    if not max_size:
+        return None
+    ttls = {method['method']: method['ttl'] for method in methods.values() if method.get('ttl')}
+    return ResponseCache(ttls, max_size)
@@ -0,0 +1,90 @@
+import json
+import logging
+import random
+import time
+from typing import Dict, NamedTuple
+
+import vk_api
+
+from fetcher import DATA_PATH, metrics
+from fetcher.index import Journal
+from fetcher.utils import save
+
+# error class of failures without an api error code, e.g. timeouts and broken connections
+NETWORK = 'network'
+# rounds of retries of deferred entities at the end of a stage and the base delay before a round, in seconds
+DEFER_ROUNDS = 3
+DEFER_DELAY = 5.
+# entities which are still failing after all rounds
+DEAD_LETTERS = DATA_PATH / 'dead-letters.jsonl'
+
+
+class Policy(NamedTuple):
+    # number of tries of a call in place, including the first one
+    attempts: int
+    # base and max delay of exponential backoff, in seconds
+    delay: float
+    max_delay: float
+
+
+# calls failing with errors not listed here are not retried, e.g. access denied [15] or private profile [30]
+POLICIES = {
+    # too many requests per second
+    6: Policy(5, .5, 8.),
+    # internal server error
+    10: Policy(3, 1., 16.),
+    # token has expired / token is exhausted, the call is made with another token
+    28: Policy(3, 0., 0.),
+    29: Policy(3, 0., 0.),
+    NETWORK: Policy(4, 1., 16.),
+}
+
+
+class Deferred(NamedTuple):
+    """Entity with tasks failed by transient errors, the tasks are fetched again at the end of the stage"""
+    # resolved tasks of the entity
+    data: Dict
+    # error classes of failed tasks, tasks waiting for failed ones have none
+    errors: Dict[str, object]
+
+
+def get_code(exc: Exception) -> object:
+    return exc.code if isinstance(exc, vk_api.ApiError) else NETWORK
+
+
+def is_transient(exc: Exception) -> bool:
+    return get_code(exc) in POLICIES
+
+
+def jitter(delay: float, max_delay: float, attempt: int) -> float:
+    """Full jitter, calls failed at once are spread over the whole backoff window"""
+    return random.uniform(0, min(max_delay, delay * 2 ** attempt))
+
+
+def backoff(exc: Exception, method: str, attempt: int):
+    """Returns the delay before the next try of a call failed with the error, None if the call is out of attempts"""
+    code = get_code(exc)
+    policy = POLICIES.get(code)
+    if policy is None or attempt + 1 >= policy.attempts:
+        return None
+    metrics.inc('vk_retries_total', code=code, method=method)
+    return jitter(policy.delay, policy.max_delay, attempt)
+
+
+def defer_delay(attempt: int) -> float:
+    return jitter(DEFER_DELAY, DEFER_DELAY * 2 ** DEFER_ROUNDS, attempt)
+
+
+def give_up(key: str, entity_type: str, deferred: Dict[int, Deferred], journal: Journal = None) -> None:
+    """Saves entities out of retries with the tasks they have and records them in the dead-letter log"""
+    if not deferred:
+        return
+    with DEAD_LETTERS.open('a') as f:
+        for uid, (data, errors) in deferred.items():
+            f.write(json.dumps({'time': time.time(), 'stage': key, 'type': entity_type, 'id': uid,
+                                'errors': errors}) + '\n')
+            save(uid, entity_type, data)
+            if journal:
+                journal.done(uid)
+    metrics.inc('dead_letters_total', len(deferred), stage=key)
+    logging.warning(f'fetch({key}): {len(deferred)} entities are still failing, see {DEAD_LETTERS}')
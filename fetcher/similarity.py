@@ -0,0 +1,128 @@
+import os
+from typing import List, Tuple
+
+import numpy as np
+
+from fetcher.ml import EMBEDDINGS
+from fetcher.utils import dump_array, exists, get_file, load
+
+# rows of the index multiplied by queries at once
+BLOCK = 65536
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Returns positions of the k highest scores of every row, sorted by score"""
+    k = min(k, scores.shape[1])
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+    return np.take_along_axis(top, order, axis=1)
+
+
+def search(matrix: np.ndarray, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Finds rows of the matrix most similar to queries block by block, returns their positions and scores"""
+    positions = np.empty((len(queries), 0), np.int64)
+    scores = np.empty((len(queries), 0), np.float32)
+    for start in range(0, len(matrix), BLOCK):
+        block_scores = queries @ matrix[start:start + BLOCK].T
+        best = top_k(block_scores, k)
+        # merge the best rows of the block with the best rows found so far
+        positions = np.hstack([positions, best + start])
+        scores = np.hstack([scores, np.take_along_axis(block_scores, best, 1)])
+        best = top_k(scores, k)
+        positions, scores = np.take_along_axis(positions, best, 1), np.take_along_axis(scores, best, 1)
+    return positions, scores
+
+
+def kmeans(vectors: np.ndarray, clusters: int, iterations: int = 10, sample: int = 256) -> np.ndarray:
+    """Spherical k-means over a sample of vectors, returns normalized centroids"""
+    rng = np.random.default_rng(239)
+    points = normalize(vectors[np.sort(rng.choice(len(vectors), min(len(vectors), clusters * sample), replace=False))])
+    centroids = points[rng.choice(len(points), clusters, replace=False)]
+    for _ in range(iterations):
+        assignment = np.argmax(points @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, points)
+        # empty clusters keep their centroids
+        empty = ~np.bincount(assignment, minlength=clusters).astype(bool)
+        sums[empty] = centroids[empty]
+        centroids = normalize(sums)
+    return centroids
+
+
+def build_index(entity_type, clusters: int = 0) -> int:
+    """
+    Dumps normalized embeddings, so that cosine similarity is a dot product.
+    With clusters, vectors are grouped into inverted lists by the nearest centroid and only a few lists are scanned.
+    """
+    emb_type = f'emb-{entity_type}'
+    ids, vectors = load(EMBEDDINGS[entity_type], emb_type)
+    clusters = min(clusters, len(ids))
+    lists = np.zeros(len(ids), np.int64)
+    centroids = np.empty((0, vectors.shape[1]), np.float32)
+    if clusters:
+        centroids = kmeans(vectors, clusters)
+        for start in range(0, len(ids), BLOCK):
+            lists[start:start + BLOCK] = np.argmax(normalize(vectors[start:start + BLOCK]) @ centroids.T, axis=1)
+    # vectors of a list are stored contiguously
+    order = np.argsort(lists, kind='stable')
+    offsets = np.searchsorted(lists[order], np.arange(max(clusters, 1) + 1))
+
+    file = get_file(f'{entity_type}-index', emb_type)
+    tmp = file.with_suffix('.tmp')
+    matrix = np.lib.format.open_memmap(tmp, mode='w+', dtype=np.float32, shape=vectors.shape)
+    for start in range(0, len(ids), BLOCK):
+        matrix[start:start + BLOCK] = normalize(vectors[order[start:start + BLOCK]])
+    matrix.flush()
+    del matrix
+    os.replace(tmp, file)
+    dump_array(get_file(f'{entity_type}-index.ids', emb_type), ids[order])
+    dump_array(get_file(f'{entity_type}-index.centroids', emb_type), centroids)
+    dump_array(get_file(f'{entity_type}-index.offsets', emb_type), offsets)
+    return len(ids)
+
+
+class Index:
+    """Nearest neighbour search over normalized embeddings of entities"""
+
+    def __init__(self, entity_type) -> None:
+        emb_type = f'emb-{entity_type}'
+        if not exists(f'{entity_type}-index', emb_type):
+            raise RuntimeError(f'No index of {entity_type}s found, run the index stage first')
+        self.ids, self.matrix = load(f'{entity_type}-index', emb_type)
+        self.centroids = np.load(get_file(f'{entity_type}-index.centroids', emb_type))
+        self.offsets = np.load(get_file(f'{entity_type}-index.offsets', emb_type))
+
+    def vectors(self, uids: List[int]) -> np.ndarray:
+        positions = [np.flatnonzero(self.ids == uid) for uid in uids]
+        missing = [uid for uid, p in zip(uids, positions) if not len(p)]
+        if missing:
+            raise KeyError(f'No embeddings of {missing} found')
+        return self.matrix[np.concatenate(positions)]
+
+    def search(self, queries: np.ndarray, k: int = 10, nprobe: int = 8) -> List[List[Tuple[int, float]]]:
+        """Returns ids and cosine similarities of the k nearest entities for every query"""
+        queries = normalize(np.asarray(queries, np.float32))
+        if not len(self.centroids):
+            positions, scores = search(self.matrix, queries, k)
+            return [list(zip(self.ids[p].tolist(), s.tolist())) for p, s in zip(positions, scores)]
+        results = []
+        for query, probes in zip(queries, top_k(queries @ self.centroids.T, nprobe)):
+            rows = np.concatenate([np.arange(self.offsets[i], self.offsets[i + 1]) for i in probes])
+            positions, scores = search(self.matrix[rows], query[None], k)
+            results.append(list(zip(self.ids[rows[positions[0]]].tolist(), scores[0].tolist())))
+        return results
+
+
+def query(uids: List[int], source: str, target: str, k: int = 10, nprobe: int = 8) -> List[List[Tuple[int, float]]]:
+    """Finds entities of the target type most similar to the given entities of the source type"""
+    source_index = Index(source)
+    index = source_index if target == source else Index(target)
+    # an entity is the nearest neighbour of itself
+    same = target == source
+    results = index.search(source_index.vectors(uids), k + same, nprobe)
+    return [[(i, score) for i, score in r if not (same and i == uid)][:k] for uid, r in zip(uids, results)]
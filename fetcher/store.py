@@ -0,0 +1,155 @@
+import fcntl
+import mmap
+import struct
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+from fetcher.index import DTYPE
+
+# index entry: id, offset of the record in the segment, its length or -1 for removed records
+ENTRY = struct.Struct('<qqq')
+
+
+def merge(keys: np.ndarray, entries: np.ndarray, new: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Applies new index entries to sorted ids and their (offset, length), the last entry of an id wins"""
+    # only the new entries are sorted, they are merged into the sorted ids by binary search
+    new = new[::-1]
+    ids, first = np.unique(new[:, 0], return_index=True)
+    new = new[first, 1:]
+    positions = np.searchsorted(keys, ids)
+    found = positions < len(keys)
+    found[found] = keys[positions[found]] == ids[found]
+    removed = new[:, 1] < 0
+    updated = found & ~removed
+    if updated.any():
+        entries = entries.copy()
+        entries[positions[updated]] = new[updated]
+    if (found & removed).any():
+        keys = np.delete(keys, positions[found & removed])
+        entries = np.delete(entries, positions[found & removed], axis=0)
+    added = ~found & ~removed
+    if added.any():
+        positions = np.searchsorted(keys, ids[added])
+        keys = np.insert(keys, positions, ids[added])
+        entries = np.insert(entries, positions, new[added], axis=0)
+    return keys, entries
+
+
+class RecordStore:
+    """
+    Append-only storage of records sharded by id.
+    Every shard consists of a segment file with payloads and an index file with entries pointing into the segment.
+    The index is kept in memory as sorted arrays and refreshed from the tail of the index file of a shard,
+    so writes of other processes are visible.
+    """
+
+    def __init__(self, path: Path, shards: int = 16) -> None:
+        self.path = path
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.shards = shards
+        # sorted ids of every shard and their (offset, length)
+        self.keys = [np.empty(0, DTYPE) for _ in range(shards)]
+        self.entries = [np.empty((0, 2), DTYPE) for _ in range(shards)]
+        # number of index bytes already read for each shard
+        self.positions = [0] * shards
+        self.maps: Dict[int, mmap.mmap] = {}
+
+    def segment_file(self, shard: int) -> Path:
+        return self.path / f'{shard:03}.seg'
+
+    def index_file(self, shard: int) -> Path:
+        return self.path / f'{shard:03}.idx'
+
+    @contextmanager
+    def lock(self, shard: int):
+        with (self.path / f'{shard:03}.lock').open('a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def refresh(self, shard: int = None) -> None:
+        """Reads new entries of the shard or of all shards"""
+        if shard is None:
+            for shard in range(self.shards):
+                self.refresh(shard)
+            return
+        file = self.index_file(shard)
+        # skip shards without new entries
+        if not file.exists() or file.stat().st_size <= self.positions[shard]:
+            return
+        with file.open('rb') as f:
+            f.seek(self.positions[shard])
+            data = f.read()
+        # a partially written entry is read again on the next refresh
+        size = len(data) - len(data) % ENTRY.size
+        new = np.frombuffer(data[:size], DTYPE).reshape(-1, 3)
+        self.keys[shard], self.entries[shard] = merge(self.keys[shard], self.entries[shard], new)
+        self.positions[shard] += size
+
+    def find(self, uid: int) -> Optional[Tuple[int, int]]:
+        """Returns offset and length of the record in its segment, None for unknown ids"""
+        shard = uid % self.shards
+        keys = self.keys[shard]
+        position = np.searchsorted(keys, uid)
+        if position < len(keys) and keys[position] == uid:
+            offset, length = self.entries[shard][position]
+            return int(offset), int(length)
+        return None
+
+    def append(self, uid: int, payload: bytes, length: int) -> None:
+        shard = uid % self.shards
+        with self.lock(shard):
+            with self.segment_file(shard).open('ab') as f:
+                offset = f.tell()
+                f.write(payload)
+            # the entry is written after the payload, so it never points to incomplete data
+            with self.index_file(shard).open('ab') as f:
+                f.write(ENTRY.pack(uid, offset, length))
+
+    def put(self, uid: int, payload: bytes) -> None:
+        self.append(uid, payload, len(payload))
+
+    def remove(self, uid: int) -> None:
+        self.append(uid, b'', -1)
+        self.refresh(uid % self.shards)
+
+    def __contains__(self, uid: int) -> bool:
+        if self.find(uid) is None:
+            self.refresh(uid % self.shards)
+        return self.find(uid) is not None
+
+    def get(self, uid: int) -> bytes:
+        shard = uid % self.shards
+        # the record might have been updated by another process
+        self.refresh(shard)
+        found = self.find(uid)
+        if found is None:
+            raise KeyError(f'Record {uid} not found in {self.path}')
+        offset, length = found
+        # an empty segment cannot be mapped
+        if not length:
+            return b''
+        segment = self.maps.get(shard)
+        # the segment has grown since it was mapped
+        if segment is None or len(segment) < offset + length:
+            if segment is not None:
+                segment.close()
+            with self.segment_file(shard).open('rb') as f:
+                segment = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[shard] = segment
+        return segment[offset:offset + length]
+
+    def all_ids(self) -> np.ndarray:
+        self.refresh()
+        return np.concatenate(self.keys)
+
+    def ids(self):
+        return set(self.all_ids().tolist())
+
+    def missing(self, ids: Iterable[int]) -> np.ndarray:
+        return np.setdiff1d(np.fromiter(ids, DTYPE), self.all_ids())
@@ -1,58 +1,145 @@
+import hashlib
 import json
 import logging
+import math
 import os
-import random
+import shutil
+import threading
+import time
+import uuid
+import weakref
 from collections import defaultdict
-from multiprocessing import managers
 from pathlib import Path
+from typing import Dict, Optional, Tuple
 
-from fetcher import DATA_PATH
+from fetcher import DATA_PATH, metrics
 from fetcher.exceptions import NoTokenError
-from fetcher.utils import SingletonType
 
 IS_HEALTHY = 'isHealthy'
 USE_RATE = 'useRate'
+DAILY_USE = 'dailyUse'
+WINDOW_START = 'windowStart'
+RESET_AT = 'resetAt'
 
+# requests per second VK allows for a single token
+RATE = 3
+# daily quotas of methods, methods not listed here are limited only by rate
+DAILY_LIMITS = {'wall.get': 5000}
+DAY = 24 * 60 * 60
+# a process borrows tokens of other processes instead of waiting longer than this for its own, in seconds
+BORROW_AFTER = 60.
 
-class Tokens(metaclass=SingletonType):
-    def __init__(self, tokens, path: Path, freq: int) -> None:
+
+class Tokens:
+    """Schedules requests of the given tokens, `share` scales limits down when a token is shared with others"""
+
+    def __init__(self, tokens, rate: float = RATE, limits: Dict[str, int] = None, share: float = 1.) -> None:
         self.tokens = tokens
-        # total number of operations
-        self.count = 0
-        # how often tokens are dumped
-        self.dump_freq = freq
-        self.path: Path = path
+        self.limits = {method: max(1, int(limit * share)) for method, limit in {**DAILY_LIMITS, **(limits or {})}.items()}
+        # requests are spaced by the interval with a burst of up to `rate` requests, see GCRA
+        rate *= share
+        self.interval = 1 / rate
+        self.tolerance = self.interval * max(0., rate - 1)
+        self.lock = threading.Lock()
+        # theoretical arrival time of the next request for each token
+        self.schedule = {token: 0. for token in set(tokens)}
+        self.expired = set()
         self.pull = {token: defaultdict(lambda: {
             USE_RATE: 0,
+            DAILY_USE: 0,
+            WINDOW_START: 0.,
+            RESET_AT: 0.,
             IS_HEALTHY: True
         }) for token in set(tokens)}
 
-    def get(self, method: str):
-        available = list(filter(lambda r: r[1][method][IS_HEALTHY], self.pull.items()))
-        if len(available) == 0:
-            message = f'No available tokens for {method}'
-            logging.critical(message)
-            raise NoTokenError(message)
+    def available_at(self, token: str, method: str, now: float) -> float:
+        """Returns the earliest time the token can be used for the method"""
+        if token in self.expired:
+            return math.inf
+        stats = self.pull[token][method]
+        if not stats[IS_HEALTHY]:
+            if now < stats[RESET_AT]:
+                return stats[RESET_AT]
+            # quota window has been reset, enable the token again
+            stats[IS_HEALTHY] = True
+            stats[DAILY_USE] = 0
+            stats[WINDOW_START] = 0.
+        if stats[WINDOW_START] and now - stats[WINDOW_START] >= DAY:
+            stats[DAILY_USE] = 0
+            stats[WINDOW_START] = 0.
+        limit = self.limits.get(method)
+        if limit and stats[DAILY_USE] >= limit:
+            return stats[WINDOW_START] + DAY
+        return max(now, self.schedule[token] - self.tolerance)
 
-        if self.count % self.dump_freq == 0:
-            self.dump()
-        self.count += 1
+    def pick(self, method: str, token: str, calls: Dict[str, int], now: float):
+        """Returns the earliest time a request can be made and the token to make it with"""
+        return min(((max(self.available_at(t, m, now) for m in [method, *calls]), t)
+                    for t in ([token] if token else self.pull)), default=(math.inf, None))
 
-        token = random.choice(available)[0]
-        self.use(token, method)
-        return token
+    def earliest(self, method: str, calls: Dict[str, int] = None) -> float:
+        """Returns the delay before the next request for the method without booking it"""
+        with self.lock:
+            now = time.time()
+            return self.pick(method, None, calls or {}, now)[0] - now
 
-    def dump(self) -> None:
-        with (self.path / 'stats.json').open('w') as f:
-            json.dump(self.pull, f)
+    def reserve(self, method: str, token: str = None, calls: Dict[str, int] = None):
+        """
+        Books a request slot on the token that frees up soonest, returns the token and the delay before use.
+        `calls` are numbers of calls by method packed into an execute request, they are booked against daily quotas
+        of their methods, so the token is healthy for all of them.
+        """
+        calls = calls or {}
+        with self.lock:
+            now = time.time()
+            at, token = self.pick(method, token, calls, now)
+            if at == math.inf:
+                message = f'No available tokens for {method}'
+                logging.critical(message)
+                raise NoTokenError(message)
 
-    def use(self, token: str, method: str) -> None:
-        self.pull[token][method][USE_RATE] += 1
+            # an execute request takes a single slot of the rate
+            self.schedule[token] = max(self.schedule[token], at) + self.interval
+            self.use(token, method, at)
+            for sub_method, count in calls.items():
+                self.use(token, sub_method, at, count)
+            metrics.inc('token_wait_seconds_total', max(0., at - now), method=method)
+            return token, at - now
 
-    def report(self, token: str, method: str = None) -> None:
-        methods = [method] if method else self.pull[token].keys()
-        for method in methods:
-            self.pull[token][method][IS_HEALTHY] = False
+    def dump(self, file: Path) -> None:
+        with self.lock:
+            stats = json.dumps(self.pull)
+        file.write_text(stats)
+
+    def use(self, token: str, method: str, at: float, count: int = 1) -> None:
+        stats = self.pull[token][method]
+        stats[USE_RATE] += count
+        stats[DAILY_USE] += count
+        if not stats[WINDOW_START]:
+            stats[WINDOW_START] = at
+
+    def report(self, token: str, method: str = None) -> Optional[float]:
+        """Disables an expired token or a token exhausted for the method, returns when an exhausted token resets"""
+        with self.lock:
+            if not method:
+                # token has expired and will never be available again
+                metrics.inc('tokens_expired_total')
+                self.expired.add(token)
+                for stats in self.pull[token].values():
+                    stats[IS_HEALTHY] = False
+                return
+            # quota is exhausted until the end of the current window
+            metrics.inc('tokens_exhausted_total', method=method)
+            now = time.time()
+            window_end = self.pull[token][method][WINDOW_START] + DAY
+            return self.exhaust(token, method, window_end if window_end > now else now + DAY)
+
+    def exhaust(self, token: str, method: str, until: float) -> float:
+        """Disables the token for the method until the given time, returns that time"""
+        stats = self.pull[token][method]
+        stats[IS_HEALTHY] = False
+        stats[RESET_AT] = max(stats[RESET_AT], until)
+        return stats[RESET_AT]
 
 
 def load_tokens():
@@ -65,12 +152,189 @@ def load_tokens():
         raise RuntimeError('No tokens found') from exc
 
 
-def get_token_manager():
-    return manager.Tokens(load_tokens(), path=DATA_PATH, freq=10)
+class Lease:
+    def __init__(self, tokens: Tokens, slot: int) -> None:
+        self.tokens = tokens
+        self.slot = slot
+        self.pid = os.getpid()
+        # shares of tokens of other processes, used while the leased tokens are saturated
+        self.borrowed: Tokens = None
+        # when exhaustion of a method published by other processes was last applied to borrowed tokens
+        self.checked: Dict[str, float] = {}
+
+    def start(self, file: Path, freq: float) -> None:
+        file.parent.mkdir(parents=True, exist_ok=True)
+
+        def flush():
+            while True:
+                time.sleep(freq)
+                self.tokens.dump(file)
+
+        threading.Thread(target=flush, daemon=True).start()
+
+
+# leases held by the current process
+LEASES: Dict[Tuple[str, int], Lease] = {}
+LEASES_LOCK = threading.Lock()
+
+
+def remove_pool(path: Path, key: str, pid: int) -> None:
+    """Removes leases and stats of a pool, files are removed by the process that created the pool"""
+    if os.getpid() != pid:
+        return
+    shutil.rmtree(path / 'leases' / key, ignore_errors=True)
+    for file in (path / 'stats').glob(f'{key}-*.json'):
+        file.unlink(missing_ok=True)
+
+
+def md5(token: str) -> str:
+    return hashlib.md5(token.encode()).hexdigest()
+
+
+class TokenPool:
+    """
+    Token manager shared between processes without a central server.
+    Every process leases a disjoint share of tokens on first use and schedules them locally,
+    so acquiring a token is a local operation. Stats are flushed by a background thread.
+    """
+
+    def __init__(self, tokens, path: Path, workers: int, freq: float = 10.) -> None:
+        self.tokens = sorted(set(tokens))
+        self.path = path
+        # number of processes the tokens are split between
+        self.workers = workers
+        # how often stats are flushed, in seconds
+        self.flush_freq = freq
+        self.key = uuid.uuid4().hex
+        self.generation = 0
+        # files of the pool are only needed while it is in use
+        weakref.finalize(self, remove_pool, path, self.key, os.getpid())
+
+    @property
+    def leases_path(self) -> Path:
+        return self.path / 'leases' / self.key / str(self.generation)
+
+    @property
+    def expired_path(self) -> Path:
+        return self.path / 'leases' / self.key / 'expired'
+
+    @property
+    def exhausted_path(self) -> Path:
+        return self.path / 'leases' / self.key / 'exhausted'
+
+    def renew(self) -> None:
+        """Invalidates all leases, must be called before handing the pool to a new set of processes"""
+        shutil.rmtree(self.leases_path, ignore_errors=True)
+        self.generation += 1
+        self.leases_path.mkdir(parents=True, exist_ok=True)
+
+    def claim(self) -> int:
+        """Claims a free slot, slots are shared when there are more processes than slots"""
+        self.leases_path.mkdir(parents=True, exist_ok=True)
+        for slot in range(self.workers):
+            try:
+                fd = os.open(self.leases_path / str(slot), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.write(fd, str(os.getpid()).encode())
+                os.close(fd)
+                return slot
+            except FileExistsError:
+                continue
+        return os.getpid() % self.workers
+
+    def alive(self):
+        return [t for t in self.tokens if not (self.expired_path / md5(t)).exists()]
+
+    def share(self, slot: int):
+        """Returns tokens leased to the slot and the fraction of their limits available to it"""
+        tokens = self.alive()
+        if not tokens:
+            return [], 1.
+        if len(tokens) >= self.workers:
+            return tokens[slot::self.workers], 1.
+        sharers = len(range(slot % len(tokens), self.workers, len(tokens)))
+        return [tokens[slot % len(tokens)]], 1 / sharers
+
+    def lease(self) -> Tokens:
+        with LEASES_LOCK:
+            lease = LEASES.get((self.key, self.generation))
+            # forked processes inherit leases of their parent, so they are bound to pid
+            if lease is None or lease.pid != os.getpid():
+                slot = self.claim()
+                tokens, share = self.share(slot)
+                lease = Lease(Tokens(tokens, share=share), slot)
+                lease.start(self.path / 'stats' / f'{self.key}-{slot}.json', self.flush_freq)
+                LEASES[(self.key, self.generation)] = lease
+                metrics.set_gauge('tokens_leased', len(tokens))
+            return lease.tokens
+
+    def borrow(self, method: str, calls: Dict[str, int] = None):
+        """Returns a share of the tokens of other processes, tokens they have exhausted for the methods are disabled"""
+        lease = LEASES[(self.key, self.generation)]
+        tokens = [t for t in self.alive() if t not in lease.tokens.pull]
+        if not tokens:
+            return None
+        if lease.borrowed is None or set(lease.borrowed.tokens) != set(tokens):
+            logging.warning(f'tokens: lease {lease.slot} is saturated for {method}, borrowing tokens of other leases')
+            lease.borrowed = Tokens(tokens, share=1 / self.workers)
+            lease.checked = {}
+        now = time.time()
+        by_hash = {md5(t): t for t in tokens}
+        with lease.borrowed.lock:
+            for m in [method, *(calls or {})]:
+                if now - lease.checked.get(m, 0.) < self.flush_freq:
+                    continue
+                lease.checked[m] = now
+                for file in self.exhausted_path.glob(f'*-{m}'):
+                    token = by_hash.get(file.name[:-len(m) - 1])
+                    if token:
+                        lease.borrowed.exhaust(token, m, float(file.read_text() or 0))
+        return lease.borrowed
+
+    def reserve(self, method: str, token: str = None, calls: Dict[str, int] = None):
+        try:
+            tokens = self.lease()
+            if not token and tokens.earliest(method, calls) > BORROW_AFTER:
+                # leased tokens are exhausted for the method, e.g. a single token shared by several processes got #29
+                borrowed = self.borrow(method, calls)
+                if borrowed and borrowed.earliest(method, calls) < tokens.earliest(method, calls):
+                    return borrowed.reserve(method, calls=calls)
+            return tokens.reserve(method, token, calls)
+        except NoTokenError:
+            if token:
+                raise
+            # all leased tokens are gone, take a share of the tokens that are still alive
+            lease = LEASES[(self.key, self.generation)]
+            tokens, _ = self.share(0)
+            if not tokens or set(tokens) <= set(lease.tokens.tokens):
+                raise
+            logging.warning(f'tokens: lease {lease.slot} is exhausted, sharing remaining tokens')
+            lease.tokens = Tokens(tokens, share=1 / self.workers)
+            metrics.set_gauge('tokens_leased', len(tokens))
+            return lease.tokens.reserve(method, calls=calls)
+
+    def get(self, method: str, token: str = None, calls: Dict[str, int] = None):
+        token, delay = self.reserve(method, token, calls)
+        if delay > 60:
+            logging.warning(f'All tokens are saturated for {method}, waiting for {delay:.0f} seconds')
+        if delay > 0:
+            time.sleep(delay)
+        return token
+
+    def report(self, token: str, method: str = None) -> None:
+        tokens = self.lease()
+        borrowed = LEASES[(self.key, self.generation)].borrowed
+        if token not in tokens.pull and borrowed:
+            tokens = borrowed
+        reset_at = tokens.report(token, method)
+        # let other processes know that the token has expired or is exhausted for the method
+        if not method:
+            self.expired_path.mkdir(parents=True, exist_ok=True)
+            (self.expired_path / md5(token)).touch()
+        else:
+            self.exhausted_path.mkdir(parents=True, exist_ok=True)
+            (self.exhausted_path / f'{md5(token)}-{method}').write_text(str(reset_at))
 
 
-# register Tokens class
-sync_manager = managers.SyncManager
-sync_manager.register('Tokens', Tokens)
-manager = sync_manager()
-manager.start()
+def get_token_manager(workers=32):
+    """Returns a pool of tokens split between the given number of processes"""
+    return TokenPool(load_tokens(), path=DATA_PATH, workers=workers)
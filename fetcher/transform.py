@@ -1,51 +1,120 @@
-def get_group_text(group):
-    return '\n'.join(' '.join(group[field].split()) for field in ['name', 'description', 'status'])
+import hashlib
+import inspect
+from typing import List
 
 
-def check_user(obj):
+# whitespace normalized texts of an entity, they are computed once when the entity is saved
+TEXTS = 'texts'
+
+
+def squash(text: str) -> str:
+    return ' '.join(text.split())
+
+
+def get_texts(obj, entity_type):
+    """Returns unique texts of user posts or parts of group text with normalized whitespace"""
+    if TEXTS not in obj:
+        if entity_type == 'user':
+            return list(dict.fromkeys(squash(post['text']) for post in obj['posts']))
+        return [squash(obj['group'][field]) for field in ['name', 'description', 'status']]
+    return obj[TEXTS]
+
+
+def normalize(obj, entity_type):
+    """Stores normalized texts alongside raw ones"""
     try:
-        u = obj['user']
-        # has a photo
-        assert u['has_photo']
-        # has at least 10 friends
-        assert len(obj['friends']) >= 10
-        # at least two meaningful posts
-        assert sum(1 for text in {' '.join(post['text'].split()) for post in obj['posts']} if len(text) > 30) >= 2
-        # at least five groups
-        assert len(obj['groups']) >= 5
-        # all fields are accessible
-        fields = ['id', 'sex', 'verified', 'city', 'followers_count']
-        assert all(f in u for f in fields)
-    except (KeyError, AssertionError):
-        return False
-    return True
+        obj[TEXTS] = get_texts(obj, entity_type)
+    except KeyError:
+        pass
+    return obj
 
 
-def check_group(obj):
+def get_group_text(obj):
+    return '\n'.join(get_texts(obj, 'group'))
+
+
+def check_user_info(obj):
+    u = obj['user']
+    # has a photo
+    assert u['has_photo']
+    # all fields are accessible
+    fields = ['id', 'sex', 'verified', 'city', 'followers_count']
+    assert all(f in u for f in fields)
+
+
+def check_user_friends(obj):
+    # has at least 10 friends
+    assert len(obj['friends']) >= 10
+
+
+def check_user_posts(obj):
+    # at least two meaningful posts
+    assert sum(1 for text in get_texts(obj, 'user') if len(text) > 30) >= 2
+
+
+def check_user_groups(obj):
+    # at least five groups
+    assert len(obj['groups']) >= 5
+
+
+def check_group_info(obj):
+    g = obj['group']
+    # is not closed
+    assert g['is_closed'] == 0
+    # is not deactivated
+    assert 'deactivated' not in g
+    # sufficient description
+    assert len(get_group_text(obj)) >= 500
+    # at least 50 members
+    assert g['members_count'] >= 50
+    # has a photo
+    assert g['has_photo']
+    # all fields are accessible
+    fields = ['id', 'members_count', 'activity']
+    assert all(f in g for f in fields)
+
+
+# rules of an entity by the fetched key they depend on, so an entity is rejected as soon as a failing key is fetched
+RULES = {
+    'user': {'user': check_user_info, 'friends': check_user_friends, 'posts': check_user_posts,
+             'groups': check_user_groups},
+    'group': {'group': check_group_info}
+}
+
+
+def check_keys(obj, entity_type, keys=None):
+    """Checks rules of the given keys, all rules by default"""
     try:
-        g = obj['group']
-        # is not closed
-        assert g['is_closed'] == 0
-        # is not deactivated
-        assert 'deactivated' not in g
-        # sufficient description
-        assert len(get_group_text(g)) >= 500
-        # at least 50 members
-        assert g['members_count'] >= 50
-        # has a photo
-        assert g['has_photo']
-        # all fields are accessible
-        fields = ['id', 'members_count', 'activity']
-        assert all(f in g for f in fields)
+        for key, rule in RULES[entity_type].items():
+            if keys is None or key in keys:
+                rule(obj)
     except (KeyError, AssertionError):
         return False
     return True
 
 
+def check_user(obj):
+    return check_keys(obj, 'user')
+
+
+def check_group(obj):
+    return check_keys(obj, 'group')
+
+
 def check(obj, entity_type):
     return {'user': check_user, 'group': check_group}[entity_type](obj)
 
 
+def get_rules_version() -> str:
+    """Fingerprint of the checking rules, verdicts of other versions are invalid"""
+    rules = [rule for rules in RULES.values() for rule in rules.values()]
+    source = ''.join(inspect.getsource(func) for func in [squash, get_texts, get_group_text, check_keys, *rules])
+    return hashlib.md5(source.encode()).hexdigest()[:8]
+
+
+RULES_VERSION = get_rules_version()
+
+
 def transform_user(obj):
     u = obj['user']
     u['groups_count'] = len(obj['groups'])
@@ -56,9 +125,54 @@ def transform_user(obj):
 
 def transform_group(obj):
     g = obj['group']
-    g['text'] = get_group_text(g)
+    g['text'] = get_group_text(obj)
     return g
 
 
 def transform(obj, entity_type):
     return {'user': transform_user, 'group': transform_group}[entity_type](obj)
+
+
+# fields of fetched objects read by checks, transforms and ml by the fetched key they belong to,
+# other fields are neither requested nor saved, keys without a schema are saved as they are
+SCHEMA = {
+    'user': {
+        'user': ['id', 'first_name', 'last_name', 'deactivated', 'is_closed', 'can_access_closed', 'sex', 'verified',
+                 'bdate', 'city', 'country', 'home_town', 'education', 'last_seen', 'has_photo', 'followers_count',
+                 'activities', 'interests', 'music', 'movies', 'tv', 'books', 'games', 'about'],
+        'posts': ['id', 'text']
+    },
+    'group': {
+        'group': ['id', 'name', 'screen_name', 'deactivated', 'is_closed', 'type', 'description', 'fixed_post',
+                  'members_count', 'status', 'has_photo', 'activity', 'age_limits', 'city', 'country'],
+        'posts': ['id', 'text']
+    }
+}
+# fields returned under other keys
+EXPANDED = {'education': ['university', 'university_name', 'faculty', 'faculty_name', 'graduation']}
+
+
+def project(payload, schema: List[str]):
+    """Strips an object or every object of a list down to the fields of the schema"""
+    keys = {key for field in schema for key in EXPANDED.get(field, [field])}
+
+    def strip(obj):
+        return {key: value for key, value in obj.items() if key in keys} if isinstance(obj, dict) else obj
+
+    return [strip(item) for item in payload] if isinstance(payload, list) else strip(payload)
+
+
+# lists of ids of related entities, they are also kept apart from entities to derive ids of the next stages
+ID_LISTS = {'user': ['friends', 'groups'], 'group': ['members']}
+
+# nested lists of entities stored as list columns of bundles
+LIST_COLUMNS = {'user': ['friends', 'groups', 'posts', TEXTS], 'group': ['members', 'posts', TEXTS]}
+
+
+def to_record(obj, entity_type):
+    """Flat row of a bundle: transformed entity with ids of related entities, texts of posts and normalized texts"""
+    record = transform(obj, entity_type)
+    for key in LIST_COLUMNS[entity_type]:
+        items = (get_texts(obj, entity_type) if key == TEXTS else obj.get(key)) or []
+        record[key] = [post['text'] for post in items] if key == 'posts' else items
+    return record
@@ -1,40 +1,32 @@
 import collections
 import glob
-import gzip
 import itertools
 import json
 import logging
 import math
-import multiprocessing
 import os
 import random
+import threading
+import time
+from contextlib import contextmanager
 from enum import Enum
 from functools import reduce, partial
 from pathlib import Path
-from typing import List
+from typing import List, Set, Tuple
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import sparse
 from tqdm.contrib.concurrent import process_map
 
-from fetcher import USERS_PATH, GROUPS_PATH, ML_PATH, BUNDLED_USERS_PATH, BUNDLED_GROUPS_PATH
+from fetcher import USERS_PATH, GROUPS_PATH, ML_PATH, BUNDLED_USERS_PATH, BUNDLED_GROUPS_PATH, PARTIAL_PATH, STORAGE
+from fetcher import metrics
 from fetcher.exceptions import FileDamagedError
-from fetcher.transform import check
-
-
-class SingletonType(type):
-    def __new__(mcs, name, bases, attrs):
-        # Assume the target class is created (i.e. this method to be called) in the main thread.
-        cls = super(SingletonType, mcs).__new__(mcs, name, bases, attrs)
-        cls.__shared_instance_lock__ = multiprocessing.Lock()
-        return cls
-
-    def __call__(cls, *args, **kwargs):
-        with cls.__shared_instance_lock__:
-            try:
-                return cls.__shared_instance__
-            except AttributeError:
-                cls.__shared_instance__ = super(SingletonType, cls).__call__(*args, **kwargs)
-                return cls.__shared_instance__
+from fetcher.index import IdIndex, IdLog, Manifest, lookup, DTYPE
+from fetcher.store import RecordStore
+from fetcher.transform import check, normalize, to_record, RULES_VERSION, ID_LISTS
 
 
 def deep_merge(*args, add_keys=True):
@@ -66,7 +58,7 @@ def deep_merge(*args, add_keys=True):
 
 
 class Modes(Enum):
-    JSON, ARCHIVE, DF = range(3)
+    JSON, ARCHIVE, DF, STORE, ARRAY = range(5)
 
 
 def get_path(entity_type: str):
@@ -76,69 +68,377 @@ def get_path(entity_type: str):
         'bundle-user': BUNDLED_USERS_PATH,
         'bundle-group': BUNDLED_GROUPS_PATH,
         'df-user': ML_PATH,
-        'df-group': ML_PATH
+        'df-group': ML_PATH,
+        'emb-user': ML_PATH,
+        'emb-group': ML_PATH,
+        'graph-user': ML_PATH,
+        'graph-group': ML_PATH
     }[entity_type]
 
 
 def get_mode(entity_type: str):
+    raw_mode = Modes.STORE if STORAGE == 'store' else Modes.JSON
     return {
-        'user': Modes.JSON, 'group': Modes.JSON,
+        'user': raw_mode, 'group': raw_mode,
         'bundle-user': Modes.ARCHIVE, 'bundle-group': Modes.ARCHIVE,
-        'df-user': Modes.DF, 'df-group': Modes.DF
+        'df-user': Modes.DF, 'df-group': Modes.DF,
+        'emb-user': Modes.ARRAY, 'emb-group': Modes.ARRAY,
+        'graph-user': Modes.ARRAY, 'graph-group': Modes.ARRAY
     }[entity_type]
 
 
 def get_ext(mode):
-    return {Modes.JSON: 'json', Modes.ARCHIVE: 'bz', Modes.DF: 'parquet'}[mode]
+    return {Modes.JSON: 'json', Modes.ARCHIVE: 'parquet', Modes.DF: 'parquet', Modes.ARRAY: 'npy'}[mode]
 
 
 def get_file(name, entity_type: str):
     return get_path(entity_type) / f'{name}.{get_ext(get_mode(entity_type))}'
 
 
+# record stores opened by the current process
+stores = {}
+
+
+def get_store(entity_type: str) -> RecordStore:
+    if entity_type not in stores:
+        stores[entity_type] = RecordStore(get_path(entity_type) / 'store')
+    return stores[entity_type]
+
+
+# id indexes opened by the current process
+indexes = {}
+
+
+def get_index(entity_type: str) -> IdIndex:
+    if entity_type not in indexes:
+        index = IdIndex(get_path(entity_type) / 'ids.idx')
+        if not index.exists():
+            # build the index from files stored before it was introduced
+            path = str(get_path(entity_type) / f'*.{get_ext(get_mode(entity_type))}')
+            index.add(*map(lambda p: int(Path(p).stem), glob.glob(path)))
+        indexes[entity_type] = index
+    return indexes[entity_type]
+
+
+# verdict logs opened by the current process
+verdicts = {}
+
+
+def get_verdicts(entity_type: str) -> IdLog:
+    """Log of check results of stored entities, every version of checking rules has its own log"""
+    if entity_type not in verdicts:
+        verdicts[entity_type] = IdLog(get_path(entity_type) / f'verdicts-{RULES_VERSION}.idx')
+    return verdicts[entity_type]
+
+
+# stamp logs opened by the current process
+stamps = {}
+
+
+def get_stamps(entity_type: str) -> IdLog:
+    """Log of times entities were saved at, entities saved before it was introduced have no stamp"""
+    if entity_type not in stamps:
+        stamps[entity_type] = IdLog(get_path(entity_type) / 'stamps.idx')
+    return stamps[entity_type]
+
+
+def get_id_lists(entity_type: str, key: str) -> RecordStore:
+    """Store of lists of related ids, so that a list is read without loading the whole entity"""
+    if (entity_type, key) not in stores:
+        stores[(entity_type, key)] = RecordStore(get_path(entity_type) / 'lists' / key)
+    return stores[(entity_type, key)]
+
+
+def load_ids(name, entity_type: str, key: str) -> np.ndarray:
+    """Returns the list of related ids of an entity"""
+    id_lists = get_id_lists(entity_type, key)
+    if name in id_lists:
+        return np.frombuffer(id_lists.get(name), DTYPE)
+    if not exists(name, entity_type):
+        return np.empty(0, DTYPE)
+    # entity was saved before lists were kept apart
+    ids = np.array(load(name, entity_type).get(key) or [], DTYPE)
+    id_lists.put(name, ids.tobytes())
+    return ids
+
+
+def get_manifest(entity_type: str) -> Manifest:
+    return Manifest(get_path(f'bundle-{entity_type}'))
+
+
 def discover(entity_type: str):
-    path = str(get_path(entity_type) / f'*.{get_ext(get_mode(entity_type))}')
+    mode = get_mode(entity_type)
+    if mode is Modes.STORE:
+        return get_store(entity_type).ids()
+    if mode is Modes.JSON:
+        return set(get_index(entity_type).ids().tolist())
+    path = str(get_path(entity_type) / f'*.{get_ext(mode)}')
     return set(map(lambda p: int(Path(p).stem), glob.glob(path)))
 
 
+def missing(ids, entity_type: str):
+    """Returns ids of entities which are not stored yet"""
+    mode = get_mode(entity_type)
+    if mode is Modes.STORE:
+        return set(get_store(entity_type).missing(ids).tolist())
+    if mode is Modes.JSON:
+        return set(get_index(entity_type).missing(ids).tolist())
+    return set(ids) - discover(entity_type)
+
+
+def exists(name, entity_type: str) -> bool:
+    if get_mode(entity_type) is Modes.STORE:
+        return name in get_store(entity_type)
+    return get_file(name, entity_type).exists()
+
+
+@contextmanager
+def replacing(file: Path):
+    """Yields a temporary file that replaces the given one once it is completely written"""
+    tmp = file.with_name(f'{file.name}.{os.getpid()}-{threading.get_ident()}.tmp')
+    try:
+        yield tmp
+        os.replace(tmp, file)
+    finally:
+        if tmp.exists():
+            os.remove(tmp)
+
+
+def dump_array(file: Path, array: np.ndarray) -> None:
+    with replacing(file) as tmp, tmp.open('wb') as f:
+        np.save(f, array)
+
+
 def save(name, entity_type: str, obj):
     mode = get_mode(entity_type)
+    if mode in [Modes.JSON, Modes.STORE]:
+        # entities are normalized and checked once, when they are saved
+        obj = normalize(obj, entity_type)
+        get_verdicts(entity_type).append([name], [check(obj, entity_type)])
+        get_stamps(entity_type).append([name], [time.time_ns()])
+        for key in ID_LISTS[entity_type]:
+            if key in obj:
+                get_id_lists(entity_type, key).put(name, np.array(obj[key] or [], DTYPE).tobytes())
+    if mode is Modes.STORE:
+        data = json.dumps(obj).encode()
+        get_store(entity_type).put(name, data)
+        metrics.inc('entities_saved_total', entity_type=entity_type)
+        metrics.inc('bytes_written_total', len(data), entity_type=entity_type)
+        return
     file = get_file(name, entity_type)
+    # files are replaced at once, so a killed worker never leaves a truncated file
     if mode is Modes.JSON:
-        with file.open('w') as f:
+        with replacing(file) as tmp, tmp.open('w') as f:
             json.dump(obj, f)
+        get_index(entity_type).add(name)
     elif mode is Modes.ARCHIVE:
-        with gzip.open(file, 'wt', encoding='utf-8', compresslevel=9) as f:
-            json.dump(obj, f)
+        if isinstance(obj, pd.DataFrame):
+            with replacing(file) as tmp:
+                obj.to_parquet(tmp, index=False)
+        else:
+            raise RuntimeError(f'Got mode {mode}, but obj is not a DataFrame')
     elif mode is Modes.DF:
         if isinstance(obj, pd.DataFrame):
-            obj.to_parquet(file)
+            with replacing(file) as tmp:
+                obj.to_parquet(tmp)
         else:
             raise RuntimeError(f'Got mode {mode}, but obj is not a DataFrame')
     else:
         raise RuntimeError(f'Got unknown mode {mode} ')
+    if mode is Modes.JSON:
+        metrics.inc('entities_saved_total', entity_type=entity_type)
+    metrics.inc('bytes_written_total', file.stat().st_size, entity_type=entity_type)
 
 
-def load(name, entity_type: str, raise_exception=True):
+def load(name, entity_type: str, raise_exception=True, columns=None):
     mode = get_mode(entity_type)
+    metrics.inc('files_parsed_total', entity_type=entity_type)
+    if mode is Modes.STORE:
+        store = get_store(entity_type)
+        try:
+            return json.loads(store.get(name))
+        except json.decoder.JSONDecodeError as e:
+            store.remove(name)
+            if raise_exception:
+                raise FileDamagedError(f'Data of {entity_type} {name} is damaged') from e
+            return
     file = get_file(name, entity_type)
     try:
         if mode is Modes.JSON:
             with file.open('r') as f:
                 return json.load(f)
-        elif mode is Modes.ARCHIVE:
-            with gzip.open(file, 'rt', encoding='utf-8') as f:
-                return json.load(f)
-        elif mode is Modes.DF:
-            return pd.read_parquet(file)
+        elif mode in [Modes.ARCHIVE, Modes.DF]:
+            return pd.read_parquet(file, columns=columns)
+        elif mode is Modes.ARRAY:
+            return np.load(get_file(f'{name}.ids', entity_type)), np.load(file, mmap_mode='r')
         else:
             raise RuntimeError(f'Got unknown mode {mode} ')
     except json.decoder.JSONDecodeError as e:
         os.remove(file)
+        if mode is Modes.JSON:
+            get_index(entity_type).remove(name)
         if raise_exception:
             raise FileDamagedError(f'Data of {entity_type} {name} is damaged') from e
 
 
+def is_missing(value) -> bool:
+    return value is None or isinstance(value, float) and math.isnan(value)
+
+
+class Writer:
+    """Writes a dataframe into a parquet file chunk by chunk, every chunk becomes a row group"""
+
+    def __init__(self, name, entity_type: str, schema: pa.Schema) -> None:
+        self.entity_type = entity_type
+        self.file = get_file(name, entity_type)
+        self.tmp = self.file.with_suffix('.tmp')
+        self.schema = schema
+        self.writer = None
+        self.rows = 0
+
+    def write(self, df: pd.DataFrame) -> None:
+        columns = [name for name in self.schema.names if name != df.index.name]
+        df = df.reindex(columns=columns)
+        for field in self.schema:
+            # columns typed differently in different bundles are widened to strings
+            if pa.types.is_string(field.type) and field.name in columns and \
+                    pd.api.types.infer_dtype(df[field.name], skipna=True) not in ['string', 'empty']:
+                df[field.name] = df[field.name].map(lambda value: value if is_missing(value) else str(value))
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=True)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.tmp, table.schema)
+        # pandas metadata of the first chunk describes the whole file
+        self.writer.write_table(table.replace_schema_metadata(self.writer.schema.metadata))
+        self.rows += len(df)
+
+    def keep(self, exclude: np.ndarray) -> None:
+        """Copies rows of the existing file except for the excluded ids"""
+        if not self.file.exists():
+            return
+        f = pq.ParquetFile(self.file)
+        for i in range(f.num_row_groups):
+            df = f.read_row_group(i).to_pandas()
+            self.write(df[~df.index.isin(exclude)])
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+            os.replace(self.tmp, self.file)
+            metrics.inc('bytes_written_total', self.file.stat().st_size, entity_type=self.entity_type)
+        elif self.file.exists():
+            # nothing is left of the previous file
+            os.remove(self.file)
+
+
+class Matrix:
+    """Writes float32 embeddings into a preallocated memory-mapped matrix aligned to an array of ids"""
+
+    def __init__(self, name, entity_type: str, rows: int, dim: int) -> None:
+        self.file = get_file(name, entity_type)
+        self.ids_file = get_file(f'{name}.ids', entity_type)
+        self.tmp = self.file.with_suffix('.tmp')
+        self.ids = np.empty(rows, dtype=np.int64)
+        self.matrix = np.lib.format.open_memmap(self.tmp, mode='w+', dtype=np.float32, shape=(rows, dim))
+        self.rows = 0
+
+    def write(self, chunk: Tuple[np.ndarray, np.ndarray]) -> None:
+        ids, vectors = chunk
+        self.ids[self.rows:self.rows + len(ids)] = ids
+        self.matrix[self.rows:self.rows + len(ids)] = vectors
+        self.rows += len(ids)
+
+    def keep(self, exclude: np.ndarray) -> None:
+        """Copies rows of the existing matrix except for the excluded ids"""
+        if not self.ids_file.exists():
+            return
+        ids, matrix = np.load(self.ids_file), np.load(self.file, mmap_mode='r')
+        for start in range(0, len(ids), 65536):
+            block = slice(start, start + 65536)
+            mask = ~np.isin(ids[block], exclude)
+            self.write((ids[block][mask], matrix[block][mask]))
+
+    def close(self) -> None:
+        if self.rows == len(self.ids):
+            self.matrix.flush()
+            del self.matrix
+            os.replace(self.tmp, self.file)
+        else:
+            # fewer rows than preallocated, copy filled rows block by block
+            result = np.lib.format.open_memmap(self.file, mode='w+', dtype=np.float32,
+                                               shape=(self.rows, self.matrix.shape[1]))
+            for start in range(0, self.rows, 65536):
+                result[start:start + 65536] = self.matrix[start:min(start + 65536, self.rows)]
+            result.flush()
+            del result, self.matrix
+            os.remove(self.tmp)
+        dump_array(self.ids_file, self.ids[:self.rows])
+
+
+class Graph:
+    """
+    Writes lists of related ids of entities as a CSR adjacency matrix.
+    Rows are entities in the order they are written, columns are sorted unique related ids.
+    """
+
+    def __init__(self, name, entity_type: str) -> None:
+        self.name, self.entity_type = name, entity_type
+        # the main file holds row pointers and is written last
+        self.file = get_file(name, entity_type)
+        self.files = {part: get_file(f'{name}.{part}', entity_type) for part in ['indices', 'rows', 'cols']}
+        # related ids are appended to a temporary file until all columns are known
+        self.tmp = self.file.with_suffix('.tmp')
+        self.edges = self.tmp.open('wb')
+        self.ids, self.lengths = [], []
+        self.rows = 0
+
+    def write(self, chunk: Tuple[np.ndarray, np.ndarray, np.ndarray]) -> None:
+        ids, lengths, related = chunk
+        self.edges.write(related.astype(DTYPE).tobytes())
+        self.ids.append(ids.astype(DTYPE))
+        self.lengths.append(lengths.astype(DTYPE))
+        self.rows += len(ids)
+
+    def keep(self, exclude: np.ndarray) -> None:
+        """Copies rows of the existing matrix except for the excluded ids"""
+        if not self.file.exists():
+            return
+        matrix, rows, cols = load_graph(self.name, self.entity_type)
+        lengths = np.diff(matrix.indptr)
+        mask = ~np.isin(rows, exclude)
+        self.write((rows[mask], lengths[mask], cols[matrix.indices[np.repeat(mask, lengths)]]))
+
+    def close(self) -> None:
+        self.edges.close()
+        related = np.fromfile(self.tmp, DTYPE)
+        cols = np.unique(related)
+        indices = np.searchsorted(cols, related).astype(np.int32 if len(cols) < 2 ** 31 else np.int64)
+        dump_array(self.files['indices'], indices)
+        dump_array(self.files['rows'], np.concatenate([np.empty(0, DTYPE), *self.ids]))
+        dump_array(self.files['cols'], cols)
+        dump_array(self.file, np.concatenate([[0], np.cumsum(np.concatenate([np.empty(0, DTYPE), *self.lengths]))]))
+        os.remove(self.tmp)
+
+
+def load_graph(name, entity_type: str) -> Tuple[sparse.csr_matrix, np.ndarray, np.ndarray]:
+    """Returns a memory-mapped CSR adjacency matrix, ids of its rows and ids of its columns"""
+    load_part = partial(np.load, mmap_mode='r')
+    indptr, indices, rows, cols = (load_part(get_file(f'{name}{part}', entity_type))
+                                   for part in ['', '.indices', '.rows', '.cols'])
+    matrix = sparse.csr_matrix((np.ones(len(indices), np.int8), indices, indptr), shape=(len(rows), len(cols)))
+    return matrix, rows, cols
+
+
+def migrate(entity_type: str) -> int:
+    """Moves json files of entities into the record store"""
+    store = get_store(entity_type)
+    files = glob.glob(str(get_path(entity_type) / f'*.{get_ext(Modes.JSON)}'))
+    for file in files:
+        with open(file, 'rb') as f:
+            store.put(int(Path(file).stem), f.read())
+        os.remove(file)
+    return len(files)
+
+
 def make_chunks(lst, n):
     """Yield successive n-sized chunks from lst."""
     for i in range(0, len(lst), n):
@@ -146,35 +446,154 @@ def make_chunks(lst, n):
 
 
 def check_chunk(chunk, entity_type):
-    return {uid for uid in chunk if check(load(uid, entity_type, raise_exception=False), entity_type)}
+    results = [check(load(uid, entity_type, raise_exception=False), entity_type) for uid in chunk]
+    get_verdicts(entity_type).append(chunk, results)
+    return {uid for uid, ok in zip(chunk, results) if ok}
 
 
 def verify(ids, entity_type, chunk_size=1000, track=False):
-    total = math.ceil(len(ids) / chunk_size)
-    id_sets = process_map(partial(check_chunk, entity_type=entity_type),
-                          make_chunks(list(ids), chunk_size), chunksize=1, total=total, disable=not track)
-    return reduce(lambda a, b: a | b, id_sets)
-
-
-def process_chunk(chunk, entity_type, k):
-    data = [load(uid, entity_type) for uid in chunk]
+    """Returns ids of stored entities that pass the check, only entities without a verdict are loaded"""
+    ids = set(ids) - missing(ids, entity_type)
+    checked, results = get_verdicts(entity_type).read()
+    known = np.isin(checked, np.fromiter(ids, np.int64))
+    unknown = ids - set(checked[known].tolist())
+    passed = set(checked[known & (results == 1)].tolist())
+    if unknown:
+        logging.info(f'check: {len(unknown)} {entity_type}s have no verdict yet')
+        total = math.ceil(len(unknown) / chunk_size)
+        id_sets = process_map(partial(check_chunk, entity_type=entity_type),
+                              make_chunks(list(unknown), chunk_size), chunksize=1, total=total, disable=not track)
+        passed = reduce(lambda a, b: a | b, id_sets, passed)
+    return passed
+
+
+def process_chunk(chunk, entity_type, k, chunk_stamps):
+    data = pd.json_normalize([to_record(load(uid, entity_type), entity_type) for uid in chunk])
     save(k, f'bundle-{entity_type}', data)
+    # the bundle is complete, point its entities to it
+    get_manifest(entity_type).add(chunk, k, chunk_stamps)
 
 
 def dump_chunks(entity_type, chunk_size=1000):
-    ids = verify(discover(entity_type), entity_type)
-    if len(ids):
-        total = math.ceil(len(ids) / chunk_size)
-        process_map(process_chunk, make_chunks(list(ids), chunk_size),
-                    itertools.repeat(entity_type), itertools.count(), chunksize=1, total=total)
-        logging.info(f'merger: dumped {len(ids)} {entity_type}s, {total} chunks total')
+    """Appends new and changed entities to new bundles, entities which are already merged are left in place"""
+    bundle_type = f'bundle-{entity_type}'
+    manifest = get_manifest(entity_type)
+    ids = np.sort(np.fromiter(verify(discover(entity_type), entity_type), np.int64))
+    merged, bundles = manifest.read()
+    # entities that no longer pass the check are dropped from bundles
+    dropped = merged[(bundles >= 0) & ~np.isin(merged, ids)]
+    if len(dropped):
+        manifest.drop(dropped)
+        logging.info(f'merger: dropped {len(dropped)} {entity_type}s')
+
+    current = lookup(ids, *get_stamps(entity_type).read(), default=0)
+    changed = (lookup(ids, merged, bundles, default=-1) < 0) | \
+        (current > lookup(ids, *manifest.stamps.read(), default=-1))
+    todo, current = ids[changed], current[changed]
+    if len(todo):
+        total = math.ceil(len(todo) / chunk_size)
+        start = manifest.reserve(total)
+        process_map(process_chunk, make_chunks(todo.tolist(), chunk_size), itertools.repeat(entity_type),
+                    itertools.count(start), make_chunks(current.tolist(), chunk_size), chunksize=1, total=total)
+        logging.info(f'merger: dumped {len(todo)} new or changed {entity_type}s, {total} chunks total')
+    elif len(ids):
+        logging.info(f'merger: all {len(ids)} {entity_type}s are merged already')
     else:
         logging.warning(f'merger: no suitable {entity_type}s found')
 
+    # bundles without live entities are removed
+    _, bundles = manifest.read()
+    for k in discover(bundle_type) - set(bundles.tolist()):
+        os.remove(get_file(k, bundle_type))
+
+
+class Pages:
+    """Pages of a paginated request streamed to disk, so that an interrupted fetch resumes from the last page"""
+
+    def __init__(self, name, offsets: List[int]) -> None:
+        self.file = PARTIAL_PATH / f'{name}.jsonl'
+        self.lock = threading.Lock()
+        self.done = set()
+        if self.file.exists():
+            # resume with the plan of the interrupted fetch, a damaged tail is cut off and fetched again
+            with self.file.open('rb+') as f:
+                end = 0
+                try:
+                    offsets = json.loads(f.readline())['offsets']
+                    end = f.tell()
+                    for line in iter(f.readline, b''):
+                        self.done.add(json.loads(line)['offset'])
+                        end = f.tell()
+                except (json.decoder.JSONDecodeError, KeyError):
+                    pass
+                f.truncate(end)
+            logging.info(f'fetch: resuming {name}, {len(self.done)} out of {len(offsets)} pages cached')
+        if not self.file.exists() or not self.file.stat().st_size:
+            with self.file.open('w') as f:
+                f.write(json.dumps({'offsets': offsets}) + '\n')
+        self.offsets = offsets
+
+    def missing(self) -> List[int]:
+        return [offset for offset in self.offsets if offset not in self.done]
+
+    def add(self, offset, items) -> None:
+        with self.lock, self.file.open('a') as f:
+            f.write(json.dumps({'offset': offset, 'items': items}) + '\n')
+            self.done.add(offset)
+
+    def drop(self) -> None:
+        """Removes fetched pages, a fetch of the pages starts over with a new plan"""
+        self.file.unlink(missing_ok=True)
+
+    def collect(self, size):
+        """Reads all pages back and samples them, the file is removed once every page is fetched"""
+        with self.file.open('r') as f:
+            f.readline()
+            items = flatten(json.loads(line)['items'] for line in f)
+        if not self.missing():
+            os.remove(self.file)
+        return sample(items, size)
+
 
 def sample(lst, size):
     return lst if len(lst) <= size or size == -1 else random.sample(lst, size)
 
 
+# generator of samples of ids
+rng = np.random.default_rng(239)
+# lower bound of the expected share of candidates passing the check, it bounds fetches of a stage with a target
+MIN_PASS_RATE = 0.05
+
+
+def candidates_needed(target: int, passed: int, checked: int, prior: int) -> float:
+    """
+    Returns how many more candidates are expected to be fetched until the target number of them pass the check.
+    The share of passed candidates starts at a half and follows checks once about `prior` candidates are checked.
+    """
+    rate = max((passed + prior / 2) / (checked + prior), MIN_PASS_RATE)
+    return (target - passed) / rate * 1.1
+
+
+def sample_ids(ids: np.ndarray, size: int) -> np.ndarray:
+    return ids if len(ids) <= size or size == -1 else rng.choice(ids, size, replace=False)
+
+
+def make_sample(consume: str, produce: str, size: int, source: Set[int], per_entity: bool = False) -> Set[int]:
+    """Extracts data from previous stage and creates a sample based on ids from it"""
+    if consume == 'user':
+        key = 'friends' if produce == 'user' else 'groups'
+    else:
+        if produce == 'group':
+            raise AttributeError('Both consume and produce are groups')
+        key = 'members'
+
+    # only lists of ids are read, entities themselves are not loaded
+    lists = [load_ids(uid, consume, key) for uid in source]
+    if per_entity:
+        lists = [sample_ids(ids, size) for ids in lists]
+    ids = np.unique(np.concatenate([np.empty(0, np.int64), *lists]))
+    return set((ids if per_entity else sample_ids(ids, size)).tolist())
+
+
 def flatten(iterable) -> List:
     return list(itertools.chain.from_iterable(iterable))
@@ -0,0 +1,5 @@
+import os
+import tempfile
+
+# fetcher creates its data folders on import, tests keep them out of the project
+os.environ.setdefault('VK_DATA_PATH', tempfile.mkdtemp(prefix='vk-test-'))
@@ -0,0 +1,23 @@
+import asyncio
+
+from fetcher.aio import Batcher
+
+
+def test_batcher_packs_calls_of_concurrent_coroutines():
+    sent = []
+
+    async def send(chunk):
+        sent.append(len(chunk))
+        if chunk[0][1]['id'] == 50:
+            raise RuntimeError('failed request')
+        return [values['id'] for _, values in chunk]
+
+    async def main():
+        batcher = Batcher(send)
+        return await asyncio.gather(*(batcher.call('users.get', {'id': i}) for i in range(60)))
+
+    results = asyncio.run(main())
+    assert sent == [25, 25, 10]
+    assert results[:50] == list(range(50))
+    # calls of a failed request get its error
+    assert all(isinstance(result, RuntimeError) for result in results[50:])
@@ -0,0 +1,14 @@
+import numpy as np
+
+from fetcher.index import Manifest
+
+
+def test_manifest_reserve(tmp_path):
+    manifest = Manifest(tmp_path)
+    manifest.add(np.array([1, 2]), 4, np.array([1, 1]))
+    # bundle numbers of manifests without a counter continue after the highest bundle ever assigned
+    assert manifest.reserve(2) == 5
+    # numbers are not reused once the entities of the last bundles are dropped
+    manifest.drop(np.array([1, 2]))
+    assert manifest.reserve(1) == 7
+    assert Manifest(tmp_path).reserve(1) == 8
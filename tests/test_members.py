@@ -0,0 +1,62 @@
+import pytest
+import vk_api
+
+from fetcher import PARTIAL_PATH
+from fetcher.methods import members
+
+TOTAL = 3000
+
+
+def make_run(fail=None, deactivated=False):
+    """Stub runner of execute requests, the page at offset `fail` fails with the given error code"""
+    calls = []
+
+    def run(batch):
+        calls.extend(batch)
+        results = []
+        for method, values in batch:
+            if method == 'groups.getById':
+                group = {'id': values['group_id'], 'deactivated': 'banned'} if deactivated \
+                    else {'id': values['group_id'], 'members_count': TOTAL}
+                results.append([group])
+            elif fail and values['offset'] == fail[0]:
+                results.append(vk_api.ApiError(None, method, values, False, {'error_code': fail[1], 'error_msg': ''}))
+            else:
+                offset = values['offset']
+                results.append({'count': TOTAL, 'items': list(range(offset, min(offset + 1000, TOTAL)))})
+        return results
+
+    return run, calls
+
+
+def test_members():
+    run, _ = make_run()
+    assert sorted(members(run, 'groups.getMembers', {'group_id': 1, 'count': -1})) == list(range(TOTAL))
+    assert not (PARTIAL_PATH / 'members-1.jsonl').exists()
+
+
+def test_permanent_failure_drops_pages():
+    run, _ = make_run(fail=(1000, 15))
+    with pytest.raises(vk_api.ApiError):
+        members(run, 'groups.getMembers', {'group_id': 2, 'count': -1})
+    assert not (PARTIAL_PATH / 'members-2.jsonl').exists()
+
+
+def test_transient_failure_resumes_missing_pages():
+    run, _ = make_run(fail=(2000, 10))
+    with pytest.raises(vk_api.ApiError):
+        members(run, 'groups.getMembers', {'group_id': 3, 'count': -1})
+    assert (PARTIAL_PATH / 'members-3.jsonl').exists()
+    run, calls = make_run()
+    assert sorted(members(run, 'groups.getMembers', {'group_id': 3, 'count': -1})) == list(range(TOTAL))
+    assert [values['offset'] for method, values in calls if method == 'groups.getMembers'] == [2000]
+
+
+def test_deactivated_group():
+    run, calls = make_run(deactivated=True)
+    assert members(run, 'groups.getMembers', {'group_id': 4, 'count': 100}) == []
+    assert [method for method, _ in calls] == ['groups.getById']
+    # the group of the group task is reused
+    run, calls = make_run()
+    assert members(run, 'groups.getMembers', {'group_id': 5, 'count': 100}, context={'group': {'id': 5}}) == []
+    assert calls == []
@@ -0,0 +1,50 @@
+import json
+
+import pytest
+import vk_api
+
+from fetcher.methods import make_code, split, unwrap
+
+CALLS = [('users.get', {'user_ids': 1, 'fields': 'city'}),
+         ('wall.get', {'owner_id': -2, 'count': 10}),
+         ('friends.get', {'user_id': 3})]
+
+
+def test_make_code():
+    code = make_code(CALLS[:2])
+    assert code == 'return [API.users.get({"user_ids": 1, "fields": "city"}),' \
+                   'API.wall.get({"owner_id": -2, "count": 10})];'
+
+
+def test_make_code_keeps_unicode():
+    assert json.dumps({'q': 'мемы'}, ensure_ascii=False) in make_code([('groups.search', {'q': 'мемы'})])
+
+
+def test_split():
+    response = {'response': [[{'id': 1}], {'count': 0, 'items': []}, {'count': 1, 'items': [4]}]}
+    assert split(CALLS, response) == response['response']
+
+
+def test_split_errors_as_values():
+    response = {'response': [False, {'count': 0, 'items': []}, False],
+                'execute_errors': [{'method': 'users.get', 'error_code': 6, 'error_msg': 'Too many requests'},
+                                   {'method': 'friends.get', 'error_code': 30, 'error_msg': 'Private profile'}]}
+    errors = []
+    results = split(CALLS, response, on_error=lambda code, method: errors.append((code, method)))
+    assert errors == [(6, 'users.get'), (30, 'friends.get')]
+    assert results[1] == {'count': 0, 'items': []}
+    assert [(r.code, r.method) for r in (results[0], results[2])] == [(6, 'users.get'), (30, 'friends.get')]
+    assert all(isinstance(r, vk_api.ApiError) for r in (results[0], results[2]))
+
+
+def test_split_missing_execute_errors():
+    results = split(CALLS[:1], {'response': [False]})
+    assert isinstance(results[0], vk_api.ApiError) and results[0].code is None
+
+
+def test_unwrap():
+    assert unwrap([1]) == [1]
+    error = split(CALLS[:1], {'response': [False], 'execute_errors': [{'error_code': 10}]})[0]
+    with pytest.raises(vk_api.ApiError) as e:
+        unwrap(error)
+    assert e.value.code == 10
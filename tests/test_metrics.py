@@ -0,0 +1,13 @@
+from fetcher import metrics
+
+
+def test_flush_keeps_removed_data_folder_removed(tmp_path, monkeypatch):
+    data = tmp_path / 'data'
+    monkeypatch.setattr(metrics, 'DATA_PATH', data)
+    monkeypatch.setattr(metrics, 'METRICS_PATH', data / 'metrics')
+    registry = metrics.Registry()
+    registry.flush(final=True)
+    assert not data.exists()
+    data.mkdir()
+    registry.flush()
+    assert len(list((data / 'metrics').glob('*.json'))) == 1
@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+
+from fetcher.ml import get_columns, get_outputs, iter_bundles
+from fetcher.utils import save, load
+
+
+def test_ml_reads_needed_columns_of_bundles():
+    save(0, 'bundle-group', pd.DataFrame({'id': [1, 2], 'city': [1, 2], 'members': [[3, 4], [5]]}))
+    changes = np.array([1, 2]), np.array([0, 0])
+    columns = get_columns('group')
+    assert 'members' not in columns
+    df, = iter_bundles('group', changes, columns)
+    assert df.columns.tolist() == ['id', 'city']
+
+
+def test_ml_widens_conflicting_columns_to_strings():
+    save(0, 'bundle-user', pd.DataFrame({'id': [1, 2], 'city': [1, 2], 'groups': [[3], []], 'friends': [[], []]}))
+    save(1, 'bundle-user', pd.DataFrame({'id': [3], 'city': [{'id': 4}], 'groups': [[]], 'friends': [[5]]}))
+    changes = np.array([1, 2, 3]), np.array([0, 0, 1])
+    writer = get_outputs('user', changes)['user_social.pd']
+    for df in iter_bundles('user', changes, get_columns('user')):
+        writer.write(df.drop(columns=['groups', 'friends']).set_index('id'))
+    writer.close()
+    assert load('user_social.pd', 'df-user').city.tolist() == ['1', '2', "{'id': 4}"]
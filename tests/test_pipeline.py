@@ -0,0 +1,178 @@
+from collections import Counter
+from concurrent.futures import Future
+
+import pytest
+
+from fetcher import pipeline
+from fetcher.pipeline import Pipeline, make_stages
+from fetcher.retry import Deferred
+
+TASKS = {'info': {'method': 'users.get'}}
+# entities whose first fetch fails the worker, other entities of its chunk are fetched again too
+FAILING = {110, 1105}
+
+
+class World:
+    """Entities stored by fake fetches, some fail or get deferred on their first try"""
+
+    def __init__(self) -> None:
+        self.stored = {'user': set(), 'group': set()}
+        self.fetches = Counter()
+        self.tries = Counter()
+
+    def fetch(self, uid, entity_type, tasks, token_manager, batch=False, journal=None, precheck=False, cache=None,
+              retry=None):
+        self.tries[(entity_type, uid)] += 1
+        if uid in FAILING and self.tries[(entity_type, uid)] == 1:
+            raise RuntimeError('worker failed')
+        if uid % 7 == 0 and retry is None:
+            return {uid: Deferred({}, {'info': 6})}
+        self.fetches[(entity_type, uid)] += 1
+        self.stored[entity_type].add(uid)
+        return {}
+
+    def fetch_many(self, uids, entity_type, tasks, token_manager, journal=None, precheck=False, cache=None):
+        deferred = {}
+        for uid in uids:
+            deferred.update(self.fetch(uid, entity_type, tasks, token_manager))
+        return deferred
+
+    def missing(self, ids, entity_type):
+        return set(ids) - self.stored[entity_type]
+
+    def verify(self, ids, entity_type):
+        passed = (lambda uid: uid % 3 != 0) if entity_type == 'user' else (lambda uid: uid % 2 == 0)
+        return {uid for uid in ids if uid in self.stored[entity_type] and passed(uid)}
+
+
+def neighbours(consume, produce, uid):
+    if consume == 'group':
+        return list(range(uid * 100, uid * 100 + 50))
+    if produce == 'group':
+        return [1000 + uid, 2] if uid % 5 == 0 else [1000 + uid]
+    return [uid + 1]
+
+
+def make_sample(consume, produce, size, source, per_entity=False):
+    if per_entity:
+        return {n for uid in source for n in sorted(neighbours(consume, produce, uid))[:size]}
+    ids = sorted({n for uid in source for n in neighbours(consume, produce, uid)})
+    return set(ids if size == -1 else ids[:size])
+
+
+class Executor:
+    """Runs submitted fetches at once in the current process"""
+
+    def __init__(self, max_workers=None) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class TokenManager:
+    def renew(self):
+        pass
+
+
+@pytest.fixture
+def world(monkeypatch):
+    world = World()
+    for name in ['fetch', 'fetch_many', 'missing', 'verify']:
+        monkeypatch.setattr(pipeline, name, getattr(world, name))
+    monkeypatch.setattr(pipeline, 'make_sample', make_sample)
+    monkeypatch.setattr(pipeline, 'defer_delay', lambda attempt: 0.)
+    monkeypatch.setattr(pipeline, 'ProcessPoolExecutor', Executor)
+    monkeypatch.setattr(pipeline, 'FLUSH_FREQ', 0.01)
+    # a stage that never finishes fails the test instead of hanging it
+    rounds = iter(range(1000))
+
+    def wait(futures, **kwargs):
+        assert next(rounds, None) is not None, 'stages never finish'
+        return set(futures), set()
+
+    monkeypatch.setattr(pipeline, 'wait', wait)
+    return world
+
+
+def run(todo, batch=False):
+    stages, ids = make_stages(todo, {key: TASKS for key in todo})
+    scheduler = Pipeline(stages, TokenManager(), batch=batch, workers=4)
+    scheduler.run(ids)
+    return stages, scheduler
+
+
+def sequential(todo):
+    """Ids of every stage fetched one stage after another"""
+    ids, fetched, verified = {}, {}, {}
+    for key, stage in todo.items():
+        source = stage['ids']
+        if isinstance(source, dict):
+            upstream = todo[source['from']]['type']
+            base = verified[source['from']] if source.get('only_verified') else fetched[source['from']]
+            ids[key] = make_sample(upstream, stage['type'], source['count'], base, source.get('per_entity', False))
+        else:
+            ids[key] = set(source)
+        fetched[key] = ids[key]
+        verified[key] = {uid for uid in ids[key] if (uid % 3 != 0 if stage['type'] == 'user' else uid % 2 == 0)}
+    return ids
+
+
+TODO = {
+    'base_groups': {'type': 'group', 'ids': [1, 2]},
+    # streams members of base groups
+    'students': {'type': 'user', 'ids': {'from': 'base_groups', 'count': -1}},
+    # streams groups of verified students, group 2 is a base group
+    'memes': {'type': 'group', 'ids': {'from': 'students', 'count': 1, 'per_entity': True, 'only_verified': True}},
+    # streams friends of students, most of them are students in flight
+    'friends': {'type': 'user', 'ids': {'from': 'students', 'count': 1, 'per_entity': True}},
+    # waits for all memes, the sample is made of members of group 2, who are students as well
+    'followers': {'type': 'user', 'ids': {'from': 'memes', 'count': 30}},
+}
+
+
+@pytest.mark.parametrize('batch', [False, True])
+def test_pipeline_matches_sequential_stages(world, batch):
+    stages, scheduler = run(TODO, batch)
+    expected = sequential(TODO)
+    for key, stage in stages.items():
+        assert stage.done
+        assert stage.ids == expected[key]
+        assert stage.verified == world.verify(expected[key], stage.entity_type)
+        assert not stage.queue and not stage.deferred and not stage.fetched
+        assert stage.pending == 0 and stage.running == 0
+    assert not any(scheduler.owners.values()) and not scheduler.futures
+    # entities needed by several stages are fetched once, failed and deferred ones included
+    assert set(world.fetches.values()) == {1}
+    assert world.stored['user'] == expected['students'] | expected['friends'] | expected['followers']
+
+
+def test_pipeline_drops_candidates_once_target_is_reached(world):
+    todo = {
+        'base_groups': {'type': 'group', 'ids': [1, 2]},
+        'students': {'type': 'user', 'ids': {'from': 'base_groups', 'count': -1}},
+        'memes': {'type': 'group', 'target': 5,
+                  'ids': {'from': 'students', 'count': 1, 'per_entity': True, 'only_verified': True}},
+    }
+    stages, scheduler = run(todo)
+    memes = stages['memes']
+    candidates = sequential(todo)['memes']
+    assert memes.done and memes.satisfied
+    assert memes.pending == 0 and memes.running == 0 and not memes.queue
+    # dropped candidates are neither fetched nor counted as ids of the stage
+    assert memes.ids < candidates
+    assert memes.ids <= world.stored['group']
+    assert len(world.stored['group'] - {1, 2}) < len(candidates)
+    assert not any(scheduler.owners.values())
+    assert scheduler.progress.n == scheduler.progress.total
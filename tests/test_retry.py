@@ -0,0 +1,62 @@
+import vk_api
+from requests.exceptions import ConnectionError
+
+from fetcher import methods
+from fetcher.methods import get_session, make_runner
+from fetcher.retry import POLICIES, backoff, is_transient
+
+CALLS = [('users.get', {'user_ids': 1}), ('wall.get', {'owner_id': 2}), ('friends.get', {'user_id': 3})]
+
+
+def make_error(code, method='users.get'):
+    return vk_api.ApiError(None, method, {}, False, {'error_code': code, 'error_msg': ''})
+
+
+def test_is_transient():
+    assert all(is_transient(make_error(code)) for code in [6, 10, 28, 29])
+    assert not any(is_transient(make_error(code)) for code in [15, 18, 30])
+    assert is_transient(ConnectionError())
+
+
+def test_backoff():
+    policy = POLICIES[6]
+    for attempt in range(policy.attempts - 1):
+        assert 0 <= backoff(make_error(6), 'users.get', attempt) <= min(policy.max_delay, policy.delay * 2 ** attempt)
+    assert backoff(make_error(6), 'users.get', policy.attempts - 1) is None
+    assert backoff(make_error(30), 'users.get', 0) is None
+
+
+def test_session_leaves_too_many_requests_to_backoff():
+    assert 6 not in get_session('token').error_handlers
+
+
+class TokenManager:
+    def get(self, method, calls=None):
+        return 'token'
+
+    def report(self, token, method=None):
+        pass
+
+
+def test_batch_retries_only_failed_calls(monkeypatch):
+    executes = []
+    # users.get succeeds, wall.get fails with [6] once, friends.get fails for good with [30]
+    responses = iter([
+        {'response': [[{'id': 1}], False, False],
+         'execute_errors': [{'method': 'wall.get', 'error_code': 6}, {'method': 'friends.get', 'error_code': 30}]},
+        {'response': [{'count': 0, 'items': []}]},
+    ])
+
+    class Session:
+        def method(self, method, values=None, raw=False):
+            executes.append(values['code'])
+            return next(responses)
+
+    monkeypatch.setattr(methods, 'get_session', lambda token: Session())
+    monkeypatch.setattr(methods.time, 'sleep', lambda delay: None)
+    results = make_runner(TokenManager(), batch=True)(CALLS)
+    assert results[:2] == [[{'id': 1}], {'count': 0, 'items': []}]
+    assert results[2].code == 30
+    # only the call failed with a transient error is packed into the second request
+    assert len(executes) == 2 and 'API.wall.get' in executes[1]
+    assert 'API.users.get' not in executes[1] and 'API.friends.get' not in executes[1]
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from fetcher.store import RecordStore, merge
+
+
+def test_record_store(tmp_path):
+    store = RecordStore(tmp_path)
+    store.put(1, b'one')
+    store.put(17, b'seventeen')
+    store.put(2, b'two')
+    assert store.get(1) == b'one' and store.get(17) == b'seventeen'
+    # writes of another store over the same files are visible
+    other = RecordStore(tmp_path)
+    other.put(1, b'uno')
+    other.remove(2)
+    assert store.get(1) == b'uno'
+    assert 2 not in store
+    with pytest.raises(KeyError):
+        store.get(2)
+    assert store.ids() == {1, 17}
+    assert store.missing([1, 2, 3]).tolist() == [2, 3]
+
+
+def test_record_store_refreshes_read_shard(tmp_path):
+    store = RecordStore(tmp_path)
+    store.put(1, b'one')
+    store.put(2, b'two')
+    store.get(1)
+    # shards not read are not refreshed
+    assert store.positions[1] > 0 and store.positions[2] == 0
+
+
+def test_record_store_empty_record(tmp_path):
+    store = RecordStore(tmp_path)
+    store.put(5, b'')
+    assert store.get(5) == b''
+    store.put(21, b'twenty one')
+    assert store.get(5) == b'' and store.get(21) == b'twenty one'
+
+
+def test_merge():
+    rng = np.random.default_rng(0)
+    keys, entries = np.empty(0, np.int64), np.empty((0, 2), np.int64)
+    expected = {}
+    for _ in range(50):
+        new = np.column_stack([rng.integers(0, 100, 20), rng.integers(0, 1000, 20), rng.integers(-1, 10, 20)])
+        for uid, offset, length in new.tolist():
+            if length < 0:
+                expected.pop(uid, None)
+            else:
+                expected[uid] = [offset, length]
+        keys, entries = merge(keys, entries, new)
+        assert keys.tolist() == sorted(expected)
+        assert entries.tolist() == [expected[uid] for uid in sorted(expected)]
@@ -0,0 +1,28 @@
+import time
+
+from fetcher.tokens import BORROW_AFTER, DAY, Tokens, TokenPool, md5
+
+
+def test_execute_books_quotas_of_packed_calls():
+    tokens = Tokens(['a', 'b'], rate=1000, limits={'wall.get': 30})
+    assert tokens.reserve('execute', calls={'wall.get': 25})[0] == 'a'
+    assert tokens.pull['a']['wall.get']['dailyUse'] == 25
+    # a token exhausted for a packed method is not used for executes containing it
+    tokens.report('a', 'wall.get')
+    assert tokens.reserve('execute', calls={'wall.get': 1})[0] == 'b'
+    assert tokens.reserve('execute', calls={'users.get': 1})[1] < 1
+
+
+def test_saturated_lease_borrows_tokens_of_other_leases(tmp_path):
+    # two tokens split between four workers, the lease holds a half of a single token
+    pool = TokenPool(['a', 'b'], path=tmp_path, workers=4)
+    assert pool.lease().tokens == ['a']
+    pool.report('a', 'groups.getMembers')
+    token, delay = pool.reserve('groups.getMembers')
+    assert token == 'b' and delay < BORROW_AFTER
+    # other methods keep using the leased token
+    assert pool.reserve('users.get')[0] == 'a'
+    # tokens exhausted by other workers are not borrowed
+    (pool.exhausted_path / f'{md5("b")}-wall.get').write_text(str(time.time() + DAY))
+    pool.report('a', 'wall.get')
+    assert pool.reserve('wall.get')[1] > BORROW_AFTER